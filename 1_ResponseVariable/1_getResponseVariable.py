@@ -14,9 +14,24 @@ Where
 	Alpha = ["Input_SumSig"].quantile(.25)
 	log2_ChipDivInput = the response variable for transfer learning
 
+Signal sums are computed one chromosome at a time: the bigWig intervals of the
+chromosome are read once, and every promoter region is summed from a running
+(coverage weighted) total of those intervals, without per-base values (see
+bigWigSignal.py).
+Chromosomes are spread over a pool of --nbWorkers processes, each opening its
+own bigWig handles; results are merged back in promoter order. With
+--cacheDirectory the intervals read are cached per track and chromosome, later
+runs (other promoter definitions) do not read the bigWigs again.
+
+Multiple marks: several ChIP tracks (e.g. H3K27ac and H3K4me3 of one tumor)
+can be given at once. Every distinct track, the shared Input included, is read
+once; each mark gets its own Alpha (from its Input) and response column:
+	log2_ChipDivInput_<Mark>
+By default all marks share Input_Path; --inputPaths gives one Input per mark.
+
 #------------------------------------------------------------------------------
 Input required:
-1) ChipSeq.bw and matching Input.bw
+1) ChipSeq.bw (one or more marks) and matching Input.bw
 2) Parsed Transcript/promoter definition file in this format:
 	EnsmblID_T	EnsmblID_G	Gene	Strand	Chr	Start	End	RStart	REnd
 	(e.g. 2_Promoter_Definitions_hg19.txt)
@@ -32,6 +47,7 @@ Where:
 Output:
 A flat file, tab delimited containing fields:
 EnsmblID_T	EnsmblID_G	Gene	Strand	Chr	Start	End	RStart	REnd log2_ChipDivInput
+(log2_ChipDivInput_<Mark>, one per mark, when several ChIP tracks are given)
 
 #------------------------------------------------------------------------------
 What if...?
@@ -46,51 +62,96 @@ What if...?
 import os
 import time
 import argparse
+import multiprocessing
 import numpy as np
 import pandas as pd
-import pyBigWig
+
+import bigWigSignal
+from cpuCount import getAvailableCpus
 
 #------------------------------------------------------------------------------
 def parseArguments(): 
 	# Create argument parser
 	parser = argparse.ArgumentParser()   
 	# Positional mandatory arguments
-	parser.add_argument("ChIP_Path", 
-		help="FullPath to ChIP File (bw).", type=str)
+	parser.add_argument("ChIP_Path", nargs="+",
+		help="FullPath to ChIP File (bw), or one per mark.", type=str)
 	parser.add_argument("Input_Path", 
 		help="FullPath to Input File (bw).", type=str)
 	parser.add_argument("PromoterDefinitions", type=str, help="Path fo Promoter Definitions file")
+	parser.add_argument("--inputPaths", help="One Input File (bw) per ChIP File, "+\
+		"instead of Input_Path for all", nargs="+", type=str)
+	parser.add_argument("--markNames", help="Response column suffix, one per ChIP File "+\
+		"(default: ChIP file names)", nargs="+", type=str)
+	parser.add_argument("--cacheDirectory", help="Directory of cached bigWig intervals, "+\
+		"reused across runs on the same tracks", type=str)
+	parser.add_argument("--nbWorkers", help="No. of worker processes to use (default: CPUs available "+\
+		"to this process, including cgroup CPU limits)", default=getAvailableCpus(), type=int)
 	parser.add_argument("--outFileName", help="File name to use for output", type=str)
 	parser.add_argument("--outDirectory", help="Directory to write output to", default="output", type=str)
 	# Parse arguments
 	args = parser.parse_args()
+	if args.inputPaths and len(args.inputPaths) != len(args.ChIP_Path):
+		parser.error("--inputPaths needs one Input File per ChIP File")
+	if args.markNames and len(args.markNames) != len(args.ChIP_Path):
+		parser.error("--markNames needs one name per ChIP File")
+	if len(args.ChIP_Path) > 1:
+		# one response column per mark, named after the ChIP files by default
+		args.markNames = args.markNames or [os.path.splitext(os.path.basename(
+									ChIP_Path))[0] for ChIP_Path in args.ChIP_Path]
+		if len(set(args.markNames)) != len(args.markNames):
+			parser.error("Mark names must be unique: "+" ".join(args.markNames)+\
+				" (ChIP Files with the same file name need --markNames)")
 	return args
 
 #------------------------------------------------------------------------------
-# 3) Caluclate signal from promoter region
-def getSignal(Row, ChipBHW, Inp_BHW):
-	Start = int(Row["RStart"])
-	End = int(Row["REnd"])
-	Chr = str(Row["Chr"])
-	#
-	ChIP = np.array(ChipBHW.values(Chr, Start, End))
-	Input = np.array(Inp_BHW.values(Chr, Start, End))
-	#
-	ChIP_SumSig = ChIP[~np.isnan(ChIP)].sum()
-	Input_SumSig = Input[~np.isnan(Input)].sum()
-	return [ChIP_SumSig, Input_SumSig]
+# 3a) Worker task, signal of one chromosome for every track
+def getChrSignalTask(Task):
+	Chr, PromoterIdx, StartArray, EndArray, BigWigPathList, CacheDirectory = Task
+	SignalList = []
+	for BigWigPath in BigWigPathList:
+		# handles are opened per process, they can't be shared
+		Track = bigWigSignal.BigWigTrack(BigWigPath, CacheDirectory)
+		SignalList.append(bigWigSignal.getChrSignal(Track, Chr, StartArray, 
+													EndArray))
+		Track.close()
+	return PromoterIdx, SignalList
+
+#------------------------------------------------------------------------------
+# 3b) Caluclate signal from promoter regions, one pass per chromosome,
+# one column per bigWig path
+def getSignal(PromoterDF, BigWigPathList, NumWorkers, CacheDirectory=None):
+	SignalDF = pd.DataFrame(0.0, index=PromoterDF.index, columns=BigWigPathList)
+	Tasks = [(str(Chr), ChrPromoterDF.index, ChrPromoterDF["RStart"].values,
+				ChrPromoterDF["REnd"].values, BigWigPathList, CacheDirectory) \
+				for Chr, ChrPromoterDF in PromoterDF.groupby("Chr", sort=False)]
+	#--------------------------------------------------------------------------
+	def mergeResults(Results):
+		# merged on the promoter index, whatever order chromosomes finish in
+		for PromoterIdx, SignalList in Results:
+			for Col, Signal in zip(list(SignalDF), SignalList):
+				SignalDF.loc[PromoterIdx, Col] = Signal
+
+	#--------------------------------------------------------------------------
+	if NumWorkers > 1 and len(Tasks) > 1:
+		# workers are terminated on leaving the block, also if a task raises
+		with multiprocessing.Pool(processes=min(NumWorkers, len(Tasks))) as WorkerPool:
+			mergeResults(WorkerPool.imap_unordered(getChrSignalTask, Tasks))
+	else:
+		mergeResults(map(getChrSignalTask, Tasks))
+	return SignalDF
 
 #------------------------------------------------------------------------------
 # 6) Calculate the response variable from the windowed ChIP_SumSig and Input_SumSig values
-def scaleRespVarData(PromoterDF):
-	Alpha = PromoterDF["Input_SumSig"].quantile(.25)
-	# Add alpha
-	PromoterDF["Chip_SumSigAlpha"] = PromoterDF["ChIP_SumSig"].astype(float) + Alpha
-	PromoterDF["Input_SumSigAlpha"] = PromoterDF["Input_SumSig"].astype(float) + Alpha
-	# calculate response variables
-	PromoterDF["log2_ChipDivInput"] = \
-					np.log2((PromoterDF["Chip_SumSigAlpha"].astype(float)/\
-					PromoterDF["Input_SumSigAlpha"].astype(float)))
+def scaleRespVarData(PromoterDF, SignalDF, MarkList):
+	# MarkList: (response column, ChIP path, Input path) per mark
+	for ResponseCol, ChIP_Path, Input_Path in MarkList:
+		Alpha = SignalDF[Input_Path].quantile(.25)
+		# Add alpha
+		Chip_SumSigAlpha = SignalDF[ChIP_Path].astype(float) + Alpha
+		Input_SumSigAlpha = SignalDF[Input_Path].astype(float) + Alpha
+		# calculate response variables
+		PromoterDF[ResponseCol] = np.log2(Chip_SumSigAlpha / Input_SumSigAlpha)
 	# ensure the only non float value is np.nan
 	PromoterDF.replace([np.inf, -np.inf], np.nan, inplace=True)
 	# all np.nan are considered 0.0, i.e. np.log2(1)
@@ -102,7 +163,7 @@ def scaleRespVarData(PromoterDF):
 def main(LineArgs):
 	T0 = time.time()
 	# Return Sample input and output file paths
-	Sample = os.path.splitext(os.path.basename(LineArgs.ChIP_Path))[0]
+	Sample = os.path.splitext(os.path.basename(LineArgs.ChIP_Path[0]))[0]
 	# determine output directory
 	OutputFilePath = LineArgs.outDirectory
 	if not os.path.exists(LineArgs.outDirectory):
@@ -115,23 +176,23 @@ def main(LineArgs):
 	# 1) Load transcript definitions:
 	PromoterDefFile = LineArgs.PromoterDefinitions 
 	PromoterDF = pd.read_csv(PromoterDefFile, header="infer", sep="\t")
-	# 2) Load ChIP-seq data
-	ChIP_BHW = pyBigWig.open(LineArgs.ChIP_Path)
-	Inp_BHW = pyBigWig.open(LineArgs.Input_Path)
-	# 3) Calculate signal from promoter region
-	PromoterDF["SignalOutput"] = PromoterDF.apply(getSignal, 
-									args=(ChIP_BHW,Inp_BHW), 
-									axis=1)
-	# 4) Split results into separate signal types
-	SigOutCols = ["ChIP_SumSig", "Input_SumSig"]
-	PromoterDF[SigOutCols] = pd.DataFrame(PromoterDF.SignalOutput.values.tolist(), 
-							index= PromoterDF.index)
-	# 5) Calculate the response variable from the windowed ChIP_SumSig and Input_SumSig values
-	ScaledRespVarDF = scaleRespVarData(PromoterDF)
-	# 6) Remove unparse col of signal types
-	ScaledRespVarDF.drop(["SignalOutput", "ChIP_SumSig", "Input_SumSig",
-							"Chip_SumSigAlpha", "Input_SumSigAlpha"], 
-							inplace=True, axis=1)
+	# never run more workers than the CPUs we are allowed to use
+	NumWorkers = min(LineArgs.nbWorkers, getAvailableCpus())
+	print("Using "+str(NumWorkers)+" worker processes")
+	# marks: response column, ChIP track and its Input track
+	InputPathList = LineArgs.inputPaths or [LineArgs.Input_Path]*len(LineArgs.ChIP_Path)
+	if len(LineArgs.ChIP_Path) == 1:
+		ResponseColList = ["log2_ChipDivInput"]
+	else:
+		ResponseColList = ["log2_ChipDivInput_"+Mark for Mark in LineArgs.markNames]
+	MarkList = list(zip(ResponseColList, LineArgs.ChIP_Path, InputPathList))
+	# 2), 3), 4) Calculate signal from ChIP-seq and Input promoter regions,
+	# one column per distinct track, a shared Input is read once
+	BigWigPathList = list(dict.fromkeys(LineArgs.ChIP_Path + InputPathList))
+	SignalDF = getSignal(PromoterDF, BigWigPathList, NumWorkers, 
+							LineArgs.cacheDirectory)
+	# 5) Calculate the response variables from the ChIP and Input signal sums
+	ScaledRespVarDF = scaleRespVarData(PromoterDF, SignalDF, MarkList)
 	# 7) Save to file
 	print("Printing to file", OutputFilePath)
 	ScaledRespVarDF.to_csv(OutputFilePath, header=True,sep="\t",index=False)
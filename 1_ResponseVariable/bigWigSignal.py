@@ -0,0 +1,140 @@
+'''
+Purpose:
+Sum bigWig signal over arbitrary region lists, streaming the raw intervals of
+each chromosome once instead of pulling per-base values for every region.
+
+General Notes:
+The intervals of a chromosome, (start, end, value) sorted and non-overlapping,
+are turned into a cumulative, coverage weighted signal:
+	CumulativeSignal[k] = sum((End - Start) * Value) of intervals before k
+so the signal of any region [Start, End) is the difference of the cumulative
+signal at its two ends, each found with a binary search plus the covered part
+of the interval it falls in. Regions may overlap, be unsorted or extend past the
+chromosome; bases without data (or with np.nan values) contribute 0, as when
+np.nan is dropped from pyBigWig values().
+
+Interval cache (optional, BigWigTrack CacheDirectory):
+	<CacheDirectory>/<sha1>/<Chr>.npz, int32 Start/End and float32 Value
+where the sha1 covers the bigWig's real path, size, mtime and CacheVersion.
+Once a chromosome is cached, any region list (promoter definitions, window
+schemes) is answered from it without opening the bigWig again. Intervals are
+cached as read rather than as fixed-size bins: region bounds (TSS +/-1000bp,
+250bp windows from any TSS) are not bin aligned, and the intervals keep the sums
+exact. Values are float32 in the bigWig itself, so the cache is lossless.
+
+Used by 1_getResponseVariable.py and the windowed analysis scripts
+(M2A_analyses/.../F1_pt1_get250bpWindowH3K27ac.py).
+'''
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import pyBigWig
+
+# bump whenever the cached arrays change
+CacheVersion = "1"
+
+#------------------------------------------------------------------------------
+class BigWigTrack(object):
+	def __init__(self, BigWigPath, CacheDirectory=None):
+		self.BigWigPath = BigWigPath
+		self.CacheDirectory = CacheDirectory
+		# opened on the first chromosome missing from the cache
+		self.BigWig = None
+
+	#--------------------------------------------------------------------------
+	def getCachePath(self, Chr):
+		Stat = os.stat(self.BigWigPath)
+		Hash = hashlib.sha1()
+		Hash.update(("bigWig intervals v"+CacheVersion).encode())
+		Hash.update(os.path.realpath(self.BigWigPath).encode())
+		Hash.update(str((Stat.st_size, Stat.st_mtime_ns)).encode())
+		return os.path.join(self.CacheDirectory, Hash.hexdigest(), Chr+".npz")
+
+	#--------------------------------------------------------------------------
+	def getChrIntervals(self, Chr):
+		# (Start, End, Value) arrays of the chromosome; None if no data
+		if self.CacheDirectory:
+			CachePath = self.getCachePath(Chr)
+			if os.path.exists(CachePath):
+				with np.load(CachePath) as Cache:
+					ChrIntervals = (Cache["Start"].astype(np.int64),
+									Cache["End"].astype(np.int64),
+									Cache["Value"].astype(np.float64))
+				return ChrIntervals if ChrIntervals[0].shape[0] else None
+		if self.BigWig is None:
+			self.BigWig = pyBigWig.open(self.BigWigPath)
+		ChrIntervals = getChrIntervals(self.BigWig, Chr)
+		if self.CacheDirectory:
+			# chromosomes without data are cached too, as empty arrays
+			Start, End, Value = ChrIntervals if ChrIntervals is not None else \
+									(np.empty(0), np.empty(0), np.empty(0))
+			if not os.path.exists(os.path.dirname(CachePath)):
+				os.makedirs(os.path.dirname(CachePath), exist_ok=True)
+			# written aside then renamed, concurrent runs never read a partial file
+			TempPath = CachePath+"."+str(os.getpid())+".tmp"
+			with open(TempPath, "wb") as CacheFile:
+				np.savez(CacheFile, Start=Start.astype(np.int32),
+							End=End.astype(np.int32), Value=Value.astype(np.float32))
+			os.replace(TempPath, CachePath)
+		return ChrIntervals
+
+	#--------------------------------------------------------------------------
+	def close(self):
+		if self.BigWig is not None:
+			self.BigWig.close()
+			self.BigWig = None
+
+#------------------------------------------------------------------------------
+def getChrIntervals(BigWig, Chr):
+	# one read of the chromosome's intervals, as arrays; None if no data
+	Intervals = BigWig.intervals(Chr) if BigWig.chroms(Chr) else None
+	if not Intervals:
+		return None
+	Intervals = np.array(Intervals, dtype=np.float64)
+	return (Intervals[:,0].astype(np.int64), Intervals[:,1].astype(np.int64),
+			np.nan_to_num(Intervals[:,2]))
+
+#------------------------------------------------------------------------------
+def getRegionSums(ChrIntervals, StartArray, EndArray):
+	#--------------------------------------------------------------------------
+	def getCumulativeSignal(Positions):
+		# signal of all bases before each position: whole intervals ending at
+		# or before it, plus the covered part of the interval containing it
+		IntervalIdx = np.searchsorted(IntervalEnd, Positions, side="right")
+		LastIdx = np.minimum(IntervalIdx, IntervalEnd.shape[0]-1)
+		Partial = (IntervalIdx < IntervalEnd.shape[0]) & \
+					(IntervalStart[LastIdx] < Positions)
+		return CumulativeSignal[IntervalIdx] + np.where(Partial,
+						(Positions - IntervalStart[LastIdx]) * IntervalValue[LastIdx],
+						0.0)
+
+	#--------------------------------------------------------------------------
+	StartArray = np.asarray(StartArray, dtype=np.int64)
+	EndArray = np.asarray(EndArray, dtype=np.int64)
+	if ChrIntervals is None:
+		return np.zeros(StartArray.shape)
+	IntervalStart, IntervalEnd, IntervalValue = ChrIntervals
+	CumulativeSignal = np.concatenate(([0.0],
+						np.cumsum((IntervalEnd - IntervalStart) * IntervalValue)))
+	return getCumulativeSignal(EndArray) - getCumulativeSignal(StartArray)
+
+#------------------------------------------------------------------------------
+def getChrSignal(Track, Chr, StartArray, EndArray):
+	# signal of every region [Start, End) of one chromosome of a BigWigTrack
+	return getRegionSums(Track.getChrIntervals(Chr), StartArray, EndArray)
+
+#------------------------------------------------------------------------------
+def getSignal(Track, ChrArray, StartArray, EndArray):
+	# signal of every region of any region list, chromosomes read once each;
+	# Start/End arrays may be 2D (regions, windows), one Chr per row
+	ChrArray = np.asarray(ChrArray).astype(str)
+	StartArray = np.asarray(StartArray, dtype=np.int64)
+	EndArray = np.asarray(EndArray, dtype=np.int64)
+	SignalArray = np.zeros(StartArray.shape)
+	for Chr, RowIdx in pd.Series(np.arange(ChrArray.shape[0])).groupby(
+											ChrArray, sort=False).indices.items():
+		SignalArray[RowIdx] = getChrSignal(Track, Chr, StartArray[RowIdx],
+											EndArray[RowIdx])
+	return SignalArray
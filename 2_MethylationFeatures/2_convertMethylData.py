@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Purpose:
+One-time conversion of a WGBS M-value table into the binary methylation store
+read by 2_getMethylationV2.py.
+
+General Notes:
+Parsing the tab delimited table dominates the run time and peak memory of the
+feature stage for large methylomes. Converting once lets every later run
+(other promoter sets, other models) memory-map the store instead.
+
+#------------------------------------------------------------------------------
+Input Required:
+1) Methylation bed-like file, as for 2_getMethylationV2.py.
+	1A) Tab delimited
+	2A) Required headers(order does not matter):
+		chrom, (chromosome ID)
+		pos, (position of the C in the CpG)
+		mval, (caluclated mvalue of a given CpG)
+
+#------------------------------------------------------------------------------
+Output:
+1) A store directory (default: output/<Sample>.m2a) with int32 positions,
+	float32 M-values and a chromosome offset index, see methylStore.py.
+	Pass the directory in place of the MethylFilePath of 2_getMethylationV2.py.
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import methylStore
+
+#------------------------------------------------------------------------------
+def parseArguments():
+	# Create argument parser
+	parser = argparse.ArgumentParser()
+	# Positional mandatory arguments
+	parser.add_argument("MethylFilePath",
+		help="Full path to methylation bed-like file.", type=str)
+	parser.add_argument("--outFileName", help="Store (directory) name to use for output", type=str)
+	parser.add_argument("--outDirectory", help="Directory to write output to", default="output", type=str)
+
+	# Parse arguments
+	args = parser.parse_args()
+	return args
+
+#------------------------------------------------------------------------------
+def main(LineArgs):
+	T0 = time.time()
+	MethylFilePath = LineArgs.MethylFilePath
+	Sample = os.path.splitext(os.path.basename(MethylFilePath))[0]
+	OutputFilePath = LineArgs.outDirectory
+	if not os.path.exists(LineArgs.outDirectory):
+		os.mkdir(LineArgs.outDirectory)
+
+	if not LineArgs.outFileName:
+		OutputFilePath += "/" + Sample + ".m2a"
+	else:
+		OutputFilePath += "/" + LineArgs.outFileName
+	# explicit dtypes, skips type inference on the text parse
+	MethylDF = pd.read_csv(MethylFilePath, sep="\t", header="infer",
+							usecols=["chrom","pos","mval"],
+							dtype={"chrom":str, "pos":np.int64, "mval":np.float64})
+	print("Methylation data loaded, total pos, "+str(MethylDF.shape[0]))
+	IndexDF = methylStore.writeMethylStore(MethylDF, OutputFilePath)
+	print("Created methylation store:", OutputFilePath,
+			"("+str(IndexDF.shape[0])+" chromosomes)")
+	print("Total time to complete,", str(time.time()-T0)+"s")
+
+# Capture command line args, with or without defaults
+if __name__ == '__main__':
+	# Parse the arguments
+	LineArgs = parseArguments()
+	main(LineArgs)
@@ -9,6 +9,16 @@ General Notes:
 4 features/ window
 total windows/promoter = 40
 total features/promoter = 160
+(defaults; set with --windowSizes and --numWindows)
+
+Features are computed for every promoter of a chromosome at once: CpG positions
+are kept as a sorted array, every window boundary of every resolution is 
+located with a single np.searchsorted, and the window statistics come from 
+prefix sums of mval and mval^2 rather than from per-window slices. All 
+resolutions are derived from that one pass. The sums are not taken in the order
+of per-window slices: a value on a rounding tie (3 decimals) can round the other
+way, a difference of 0.001 in a few hundred values per 100k (mostly M_Ave)
+against the per-window implementation.
 
 Diagram (strand sensitive):
 RegionStart|----------|TSS|----------|RegionEnd
@@ -23,6 +33,9 @@ Input Required:
 		pos, (position of the C in the CpG)
 		mval, (caluclated mvalue of a given CpG) 
 
+	1B) Or, a binary methylation store made once from that file by
+		2_convertMethylData.py; it is detected and memory-mapped directly.
+
 2) Chromosome ID, e.g. 1,2,3...X,Y
 
 3) By default, uses the promoter definitions previously generated:
@@ -34,6 +47,23 @@ Input Notes:
 	mvalues are not constant, so a given window between two samples
 	may have a different number of Mvalues.
 
+	The file is streamed in chunks (--chunkSize rows), keeping only the current
+	chromosome's CpGs in memory when rows are grouped by chromosome. Otherwise,
+	each chromosome is first spilled to a temporary file (--spillDirectory).
+
+	--compact reads positions as int32, mvals as float32 and chromosome/strand
+	IDs as categoricals, about half the memory of the default int64/float64/
+	object columns. Window statistics are still accumulated in float64, but the
+	float32 mvals add their own error on top of the tie differences above: a
+	few more features differ by 0.001 (the rounding step) from the default.
+
+	With --cohort, MethylFilePath is a manifest of methylomes (text files or
+	stores), one path per line; blank lines and lines starting with # are
+	skipped. An optional second, tab separated column names the sample's
+	output file (default Features_<methylome file name>), needed when two
+	methylomes in different directories share a file name. Promoter regions and window boundaries are computed once, each
+	sample is then streamed in turn and written to its own feature file.
+
 #------------------------------------------------------------------------------
 Output:
 1)This script produces four main features:
@@ -50,6 +80,15 @@ also extend the features further away from the TSS. Mulitple resolutions can be
 included in the model using a CNN which will learn which features are important
 for prediction.
 
+2) With --outFormat h5, the unscaled features are instead written as a float32
+(or --featureDtype float16) HDF5 tensor (Features_<Sample>.m2f), read directly by 3_Combine.py:
+	"FeatureInput", (N,Resolutions,Windows,Features), rows in the order of the
+		metadata datasets (promoters grouped by chromosome, chromosomes in
+		order of first appearance in the promoter file), windows W-10...W10,
+		features sorted by name (Ave, FracSSD, SSD, Var);
+		attrs WindowSizes, NumWindows and Features record the layout
+	one dataset per promoter definition column, astype(bytes)
+
 #------------------------------------------------------------------------------
 What if...?
 	1) Q: the region extends passed chromosome boundaries, especially with larger
@@ -57,6 +96,8 @@ What if...?
 		A: these windows will return "np.nan", and later be converted to 0 value.
 			In fact, any window without mvalues will be returned as np.nan,
 			including centromeric or gapped regions (low map, NNNNs)
+	2) Q: the methylation file has a header but no rows?
+		A: there is one row per promoter all the same, every window np.nan.
 '''
 
 import time
@@ -64,13 +105,17 @@ import time
 import argparse
 import numpy as np
 import pandas as pd
-from pandarallel import pandarallel
-
 import os
-from contextlib import contextmanager
-import subprocess
+import ctypes
+import tempfile
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import h5py
 
-import psutil
+import methylStore
+import featureCache
+import cpgIndex
+from cpuCount import getAvailableCpus
 
 #------------------------------------------------------------------------------
 def parseArguments(): 
@@ -78,62 +123,196 @@ def parseArguments():
 	parser = argparse.ArgumentParser()   
 	# Positional mandatory arguments
 	parser.add_argument("MethylFilePath", 
-		help="Full path to methylation bed-like file.", type=str)
+		help="Full path to methylation bed-like file, or binary methylation store "+\
+		"(with --cohort: a manifest listing one such path per line, optionally followed by "+\
+		"a tab and the output file name).", type=str)
 	parser.add_argument("PromoterDefinitions", type=str, help="Path fo Promoter Definitions file")
-	parser.add_argument("--nbWorkers", help="No. of threads to use", default=psutil.cpu_count(), type=int)	
+	parser.add_argument("--nbWorkers", help="No. of worker processes to use (default: CPUs available "+\
+		"to this process, including cgroup CPU limits)", default=getAvailableCpus(), type=int)
+	parser.add_argument("--batchSize", help="No. of promoters per worker task", default=2000, type=int)
+	parser.add_argument("--windowSizes", help="Window sizes (bp), one per resolution", 
+		nargs="+", default=[250, 2500], type=int)
+	parser.add_argument("--numWindows", help="No. of windows per resolution, one value for "+\
+		"all resolutions or one per window size", nargs="+", default=[20], type=int)
+	parser.add_argument("--cacheDirectory", help="Directory of cached per-chromosome features, "+\
+		"reused and extended across runs", type=str)
+	parser.add_argument("--cpgIndex", help="CpG index directory (see cpgIndex.py), window offsets are "+\
+		"reused for chromosomes with the same CpG positions, and added otherwise", type=str)
+	parser.add_argument("--cohort", help="MethylFilePath is a manifest of methylomes, promoter "+\
+		"geometry is computed once and one feature file is written per sample", action="store_true")
 	parser.add_argument("--outFileName", help="File name to use for output", type=str)
 	parser.add_argument("--outDirectory", help="Directory to write output to", default="output", type=str)
+	parser.add_argument("--outFormat", help="tsv feature table, or h5 float32 feature tensor "+\
+		"for 3_Combine.py", choices=["tsv","h5"], default="tsv", type=str)
+	parser.add_argument("--featureDtype", help="Storage dtype of the h5 feature tensor", 
+		choices=["float32","float16"], default="float32", type=str)
+	parser.add_argument("--compact", help="Read positions as int32, mvals as float32 and "+\
+		"chromosome/strand IDs as categoricals", action="store_true")
+	parser.add_argument("--chunkSize", help="No. of methylation rows to read at a time", default=5000000, type=int)
+	parser.add_argument("--spillDirectory", help="Temporary directory for per-chromosome spill files, "+\
+		"used only if the methylation file is not grouped by chromosome", type=str)
 
 	# Parse arguments
 	args = parser.parse_args()
+	if len(args.numWindows) == 1:
+		args.numWindows = args.numWindows * len(args.windowSizes)
+	if len(args.numWindows) != len(args.windowSizes):
+		parser.error("--numWindows needs one value, or one per --windowSizes")
+	if any(N % 2 for N in args.numWindows):
+		parser.error("--numWindows must be even, windows are centered on the TSS")
+	if args.cohort and args.outFileName:
+		parser.error("--outFileName can't be used with --cohort, outputs are named per sample "+\
+			"(optionally in a second manifest column)")
+	if args.outFormat == "h5" and len(set(args.numWindows)) != 1:
+		parser.error("--outFormat h5 needs the same --numWindows for all resolutions")
 	return args
 
 #------------------------------------------------------------------------------
 # 1a)
-def getMethylData(MethylFilePath):
-	MethylDF = pd.read_csv(MethylFilePath, sep="\t", header="infer")
-	MethylDF["chrom"] = MethylDF["chrom"].astype(str)
-	MethylDF["mval"] = MethylDF["mval"].astype(np.float64)
-	MethylDF["pos"] = MethylDF["pos"].astype(int)
-	print("Methylation data loaded, total pos, "+str(MethylDF.shape[0]))
-	return MethylDF
+def getMethylDtypes(Compact=False):
+	if Compact:
+		# int32 holds any hg19/hg38 coordinate
+		return {"chrom":"category", "pos":np.int32, "mval":np.float32}
+	return {"chrom":str, "pos":np.int64, "mval":np.float64}
 
 #------------------------------------------------------------------------------
-# 1b)
-def getMethylDataByChr(MethylDF, Chr):
-	Chr = Chr.replace("chr","")
-	MethylDF = MethylDF[MethylDF["chrom"].astype(str)==str(Chr)]
-	MethylDF.sort_values(by=["pos"], inplace=True)
-	MethylDF.set_index(keys=["pos"], inplace=True)
-	print("chr"+Chr+" MethylDF Mvalues:", MethylDF.shape)
-	return MethylDF
+# 1a.1)
+def iterMethylChunks(MethylFilePath, ChunkSize, Compact=False):
+	# explicit dtypes, skips type inference on the text parse
+	Reader = pd.read_csv(MethylFilePath, sep="\t", header="infer", 
+						usecols=["chrom","pos","mval"], chunksize=ChunkSize,
+						dtype=getMethylDtypes(Compact))
+	for MethylChunkDF in Reader:
+		yield MethylChunkDF
 
 #------------------------------------------------------------------------------
-# 2)
-def getFeatureRegionDelimiters(PromoterDF, NumWindows, WindowSize):
+# 1b)
+def iterMethylDataByChr(MethylFilePath, ChunkSize, SpillDirectory=None, 
+						Compact=False):
 	#--------------------------------------------------------------------------
-	# 2.1)
-	def getRegion(Row, NumWindows, WindowSize):
-		if Row["Strand"] == "+":
-			TSS = Row["Start"]
-		else:
-			TSS = Row["End"]
-		# feature region is centered on the TSS
-		FeatureRegionStart = TSS - (WindowSize * (NumWindows/2))
-		FeatureRegionEnd = TSS + (WindowSize * (NumWindows/2))
-		return FeatureRegionStart, FeatureRegionEnd
+	# 1b.1)
+	def sortByPosition(PositionsList, MvalsList):
+		# sorted CpG positions and their mvals, as flat arrays for the window engine
+		Positions = np.concatenate(PositionsList)
+		Mvals = np.concatenate(MvalsList)
+		SortIdx = np.argsort(Positions, kind="mergesort")
+		return Positions[SortIdx], Mvals[SortIdx]
+
 	#--------------------------------------------------------------------------
-	# define feature region on strandedness, centered on TSS
-	PromoterDF["FeatureRegion"] = PromoterDF.parallel_apply(getRegion,
-											args=(NumWindows,WindowSize),
-											axis=1)
-	# split these into separate columns
-	PromoterDF[["FeatureRegionStart","FeatureRegionEnd"]] = pd.DataFrame(
-											PromoterDF.FeatureRegion.values.tolist(), 
-											index=PromoterDF.index)
-	# remove unsplit column
-	PromoterDF.drop(["FeatureRegion"],inplace=True, axis=1)
-	return PromoterDF
+	if methylStore.isMethylStore(MethylFilePath):
+		# pre-converted binary store, chromosome rows are contiguous, already
+		# sorted and memory-mapped, no parsing required
+		MethylStore = methylStore.loadMethylStore(MethylFilePath)
+		print("Methylation store mapped, total pos, "+str(MethylStore[1].shape[0]))
+		for Chr in MethylStore[0].index:
+			Positions, Mvals = methylStore.getStoreChr(MethylStore, Chr)
+			print("chr"+Chr+" MethylStore Mvalues:", Positions.shape)
+			yield Chr, Positions, Mvals
+		return
+	#
+	# Input grouped by chromosome (the usual case): stream it once, with only
+	# the current chromosome resident
+	# rows yielded per chromosome, to tell complete ones if a fallback follows
+	CompletedChrs = {}
+	CurrentChr = None
+	PositionsList, MvalsList = [], []
+	for MethylChunkDF in iterMethylChunks(MethylFilePath, ChunkSize, Compact):
+		if MethylChunkDF.empty:
+			# header only file
+			continue
+		Chroms = MethylChunkDF["chrom"].astype("category")
+		ChromCodes = Chroms.cat.codes.values
+		Positions = MethylChunkDF["pos"].values
+		Mvals = MethylChunkDF["mval"].values
+		# split the chunk into runs of a single chromosome
+		Breaks = np.flatnonzero(ChromCodes[1:] != ChromCodes[:-1]) + 1
+		for Start, Stop in zip(np.append(0, Breaks), np.append(Breaks, len(Chroms))):
+			Chr = str(Chroms.iloc[Start])
+			if Chr != CurrentChr:
+				if CurrentChr is not None:
+					print("chr"+CurrentChr+" streamed Mvalues:", sum(map(len, PositionsList)))
+					yield (CurrentChr,) + sortByPosition(PositionsList, MvalsList)
+					CompletedChrs[CurrentChr] = sum(map(len, PositionsList))
+				if Chr in CompletedChrs:
+					break
+				CurrentChr = Chr
+				PositionsList, MvalsList = [], []
+			PositionsList.append(Positions[Start:Stop])
+			MvalsList.append(Mvals[Start:Stop])
+		else:
+			continue
+		break
+	else:
+		if CurrentChr is not None:
+			print("chr"+CurrentChr+" streamed Mvalues:", sum(map(len, PositionsList)))
+			yield (CurrentChr,) + sortByPosition(PositionsList, MvalsList)
+		return
+	#
+	# A chromosome came back after another one: the input is not grouped.
+	# Restart and spill every chromosome to its own temporary file, then
+	# reload them one at a time. Of the chromosomes yielded above, only those
+	# with more rows in the spill (split ones) are yielded again, complete,
+	# and replace the earlier partial results.
+	print("Methylation input not grouped by chromosome, spilling to disk")
+	PositionsList, MvalsList = [], []
+	Dtypes = getMethylDtypes(Compact)
+	with tempfile.TemporaryDirectory(dir=SpillDirectory) as SpillPath:
+		SpillFiles = {}
+		for MethylChunkDF in iterMethylChunks(MethylFilePath, ChunkSize, Compact):
+			if MethylChunkDF.empty:
+				continue
+			for Chr, ChrChunkDF in MethylChunkDF.groupby("chrom", sort=False, 
+														observed=True):
+				Chr = str(Chr)
+				if Chr not in SpillFiles:
+					SpillFiles[Chr] = os.path.join(SpillPath, str(len(SpillFiles)))
+				with open(SpillFiles[Chr]+".pos", "ab") as PosFile:
+					ChrChunkDF["pos"].values.astype(Dtypes["pos"]).tofile(PosFile)
+				with open(SpillFiles[Chr]+".mval", "ab") as MvalFile:
+					ChrChunkDF["mval"].values.astype(Dtypes["mval"]).tofile(MvalFile)
+		for Chr, SpillFile in SpillFiles.items():
+			NumRows = os.path.getsize(SpillFile+".pos") // np.dtype(Dtypes["pos"]).itemsize
+			if CompletedChrs.get(Chr) == NumRows:
+				continue
+			Positions = np.fromfile(SpillFile+".pos", dtype=Dtypes["pos"])
+			Mvals = np.fromfile(SpillFile+".mval", dtype=Dtypes["mval"])
+			print("chr"+Chr+" spilled Mvalues:", Positions.shape[0])
+			yield (Chr,) + sortByPosition([Positions], [Mvals])
+
+#------------------------------------------------------------------------------
+# 1c)
+def getPrefixSums(Mvals):
+	# running count, sum and sum of squares of the non-nan mvals, each with a
+	# leading 0, so any run of CpGs [i, j) is summarized by Prefix[j] - Prefix[i]
+	# (always accumulated in float64, whatever the stored mval precision)
+	Mvals = np.asarray(Mvals, dtype=np.float64)
+	ValidMask = ~np.isnan(Mvals)
+	# SSD is shift invariant; centering on the chr mean keeps the squared sums
+	# small enough that differencing them does not lose precision
+	if ValidMask.any():
+		Shift = Mvals[ValidMask].mean()
+	else:
+		Shift = 0.0
+	Centered = np.where(ValidMask, Mvals - Shift, 0.0)
+	CountPrefix = np.concatenate(([0], np.cumsum(ValidMask)))
+	SumPrefix = np.concatenate(([0.0], np.cumsum(Centered)))
+	SquarePrefix = np.concatenate(([0.0], np.cumsum(np.square(Centered))))
+	return CountPrefix, SumPrefix, SquarePrefix, Shift
+
+#------------------------------------------------------------------------------
+# 2a)
+def getTSS(PromoterDF):
+	return np.where(PromoterDF["Strand"].values.astype(str) == "+",
+					PromoterDF["Start"].values, PromoterDF["End"].values)
+
+#------------------------------------------------------------------------------
+# 2b)
+def getFeatureRegionDelimiters(PromoterDF, NumWindows, WindowSize):
+	# define feature region on strandedness, centered on the TSS
+	TSS = getTSS(PromoterDF)
+	FeatureRegionStart = (TSS - (WindowSize * (NumWindows/2))).astype(np.int64)
+	FeatureRegionEnd = (TSS + (WindowSize * (NumWindows/2))).astype(np.int64)
+	return FeatureRegionStart, FeatureRegionEnd
 
 #------------------------------------------------------------------------------
 # 3)
@@ -144,72 +323,71 @@ def computeWindowRanges(NumWindows, WindowSize):
 	return WindowRanges
 
 #------------------------------------------------------------------------------
-# 4)
-def getFeatures(Row, MethylChrDF, WindowRanges):
+# 4a)
+def getBoundaryIdx(RegionStartList, Positions, WindowRangesList):
+	# every window boundary of every promoter, for every resolution side by
+	# side, (promoters, sum of (windows + 1))
+	BoundariesList = []
+	for RegionStart, WindowRanges in zip(RegionStartList, WindowRangesList):
+		WindowOffsets = np.array([w[0] for w in WindowRanges] + [WindowRanges[-1][1]])
+		BoundariesList.append(RegionStart[:,None] + WindowOffsets[None,:])
+	# first CpG at or after each boundary; a single search over the chromosome
+	# serves every resolution
+	BoundaryIdx = np.searchsorted(Positions, np.hstack(BoundariesList), side="left")
+	SplitIdx = np.cumsum([B.shape[1] for B in BoundariesList])[:-1]
+	# one (promoters, windows + 1) array per resolution
+	return np.split(BoundaryIdx, SplitIdx, axis=1)
+
+#------------------------------------------------------------------------------
+# 4b)
+def getFeatures(BoundaryIdxList, MinusStrand, PrefixSums):
 	#--------------------------------------------------------------------------
 	# 4.1)
-	def getMvalueFeatures(WinStart, WinStop, MethylChrDF, RegionSSD):
-		# determine cpg sites with signal in this window
-		#MethylationDF = MethylChrDF[(MethylChrDF["pos"]>=int(WinStart))&\
-		#							(MethylChrDF["pos"]<int(WinStop))]
-		MethylationDF = MethylChrDF.loc[int(WinStart):int(WinStop)-1]
-
-		# flatten to array of floats
-		MvalueArray = MethylationDF["mval"].values
-		# remove all potential nans
-		MvalueArray = MvalueArray[~np.isnan(MvalueArray)]
-		#
-		# Check results, if none, report np.nan
-		NumOfMvals = int(MvalueArray.size)
-		if NumOfMvals > 0:
-			# average mvalue
-			Ave = np.mean(MvalueArray)
-			# note: can't calculate window SSD, etc. if entire region SSD is 0
-			if RegionSSD == 0.0:
-				SSD = 0
-				FracSSD = 0
-				Var = 0
-			else:
-				SSD = np.square(MvalueArray - MvalueArray.mean()).sum()
-				FracSSD = SSD / RegionSSD
-				Var = SSD / NumOfMvals
-		else:
-			Ave = np.nan
-			SSD = np.nan
-			FracSSD = np.nan
-			Var = np.nan
+	def getMvalueFeatures(StartIdx, StopIdx, PrefixSums):
+		# count, average and SSD of the mvals in CpGs [StartIdx, StopIdx),
+		# np.nan wherever no mvalues fall in the window
+		CountPrefix, SumPrefix, SquarePrefix, Shift = PrefixSums
+		NumOfMvals = CountPrefix[StopIdx] - CountPrefix[StartIdx]
+		Sum = SumPrefix[StopIdx] - SumPrefix[StartIdx]
+		SquareSum = SquarePrefix[StopIdx] - SquarePrefix[StartIdx]
+		with np.errstate(invalid="ignore", divide="ignore"):
+			Ave = Sum / NumOfMvals + Shift
+			# clip the rounding noise of the difference, SSD >= 0
+			SSD = np.maximum(SquareSum - np.square(Sum) / NumOfMvals, 0.0)
+		return NumOfMvals, Ave, SSD
 
+	#--------------------------------------------------------------------------
+	# 4.2)
+	def getResolutionFeatures(BoundaryIdx, PrefixSums):
+		# window i spans CpGs [BoundaryIdx[:,i], BoundaryIdx[:,i+1])
+		# calculate sum of squared differences (SSD) over entire feature region,
+		# at the same precision as the reported features
+		_, _, RegionSSD = getMvalueFeatures(BoundaryIdx[:,0], BoundaryIdx[:,-1],
+											PrefixSums)
+		RegionSSD = np.round(RegionSSD, decimals=3)[:,None]
+		# Calculate each feature for each window,
+		NumOfMvals, Ave, SSD = getMvalueFeatures(BoundaryIdx[:,:-1], 
+												BoundaryIdx[:,1:], PrefixSums)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			FracSSD = SSD / RegionSSD
+			Var = SSD / NumOfMvals
+		# note: can't calculate window SSD, etc. if entire region SSD is 0
+		FlatRegion = (RegionSSD == 0.0) & (NumOfMvals > 0)
+		SSD[FlatRegion] = 0
+		FracSSD[FlatRegion] = 0
+		Var[FlatRegion] = 0
+		# (promoters, windows, features), features ordered as in buildHeader
+		FeatureArray = np.stack([Ave, FracSSD, Var, SSD], axis=2)
+		# calculate directionality of gene 
+		# (differentiate upstream vs downstream)
+		FeatureArray[MinusStrand] = FeatureArray[MinusStrand,::-1]
 		# we really can't justify extreme precision (not useful)
-		StatsList = np.round([Ave, FracSSD, Var, SSD],decimals=3).tolist()
-		return StatsList
+		FeatureArray = np.round(FeatureArray, decimals=3)
+		return FeatureArray.reshape(FeatureArray.shape[0], -1)
 
 	#--------------------------------------------------------------------------
-	# Define limits of feature region
-	RegionStart = int(Row["FeatureRegionStart"])
-	RegionEnd = int(Row["FeatureRegionEnd"])
-	Strand = str(Row["Strand"])
-	# calculate directionality of gene 
-	# (differentiate upstream vs downstream)
-	if Strand == "+":
-		WindowRanges = WindowRanges
-	else:
-		WindowRanges = WindowRanges[::-1]
-	# calculate sum of squared differences (SSD) over entire feature region
-	# "1" is passed to act as the pseudo region SSD
-	RegionResults = getMvalueFeatures(RegionStart, RegionEnd, MethylChrDF, 1)
-	RegionSSD = RegionResults[-1]
-	# Calculate each features for each window,
-	#DF = MethylChrDF[(MethylChrDF["pos"]>=int(RegionStart))&\
-	#			(MethylChrDF["pos"]<int(RegionEnd))]
-	DF = MethylChrDF.loc[int(RegionStart):int(RegionEnd)-1]
-
-	WindowResultsList = []
-	for WindowRange in WindowRanges:
-		FeatureResults = getMvalueFeatures(WindowRange[0]+RegionStart, 
-								WindowRange[1]+RegionStart,
-								DF, RegionSSD) 
-		WindowResultsList = WindowResultsList + FeatureResults
-	return WindowResultsList
+	return [getResolutionFeatures(BoundaryIdx, PrefixSums) \
+				for BoundaryIdx in BoundaryIdxList]
 
 #------------------------------------------------------------------------------
 # 5)
@@ -226,86 +404,323 @@ def buildHeader(NumWindows, WindowSize):
 							str(WindowSize)+"_W"+str(x)+"_M_SSD"]
 	return Header
 
+#------------------------------------------------------------------------------
+# 6)
+def getChrFeatures(ChrGeometry, ChrPositions, ChrMvals, NumWindowsList, 
+					WindowSizesList, NumWorkers, BatchSize, CacheDirectory=None,
+					CpGIdx=None, CacheUpdateList=None):
+	#--------------------------------------------------------------------------
+	# 6.1)
+	def getChrBoundaryIdx(PromoterMask):
+		# 4a) CpG offsets of the window boundaries, from the CpG index when
+		# it holds this chromosome's positions and promoters
+		RegionStartList = [RegionStart[PromoterMask] for RegionStart in \
+								ChrGeometry["RegionStartList"]]
+		if CpGIdx is None:
+			return getBoundaryIdx(RegionStartList, ChrPositions, 
+									ChrGeometry["WindowRangesList"])
+		TSS = ChrGeometry["TSS"][PromoterMask]
+		BoundaryIdxList = CpGIdx.getChrOffsets(ChrGeometry["MethylChr"], TSS, 
+												ChrPositions)
+		if BoundaryIdxList is None:
+			BoundaryIdxList = getBoundaryIdx(RegionStartList, ChrPositions, 
+												ChrGeometry["WindowRangesList"])
+			CpGIdx.addChr(ChrGeometry["MethylChr"], ChrPositions, TSS, 
+							BoundaryIdxList)
+		else:
+			print("\tCpG offsets from index")
+		return BoundaryIdxList
+
+	#--------------------------------------------------------------------------
+	# 6.2)
+	def computeFeatures(PromoterMask):
+		ChrPrefixSums = getPrefixSums(ChrMvals)
+		MinusStrand = ChrGeometry["MinusStrand"][PromoterMask]
+		BoundaryIdxList = getChrBoundaryIdx(PromoterMask)
+		# 4b) generate features for all promoters, for every window size
+		if NumWorkers > 1 and ChrPositions.size > 0 and \
+										MinusStrand.shape[0] > BatchSize:
+			# spread promoter batches over the shared memory worker pool (7)
+			return runFeaturePool(ChrPrefixSums, BoundaryIdxList, MinusStrand, 
+									NumWorkers, BatchSize)
+		return getFeatures(BoundaryIdxList, MinusStrand, ChrPrefixSums)
+
+	#--------------------------------------------------------------------------
+	T2 = time.time()
+	ChrPromoterDF = ChrGeometry["PromoterDF"]
+	AllPromoters = np.ones(ChrPromoterDF.shape[0], dtype=bool)
+	if CacheDirectory:
+		# reuse features of promoters (TSS, strand) already computed on this
+		# exact chromosome slice and window configuration
+		NumFeaturesList = [4*NumWindows for NumWindows in NumWindowsList]
+		TSS = ChrGeometry["TSS"]
+		MinusStrand = ChrGeometry["MinusStrand"]
+		CacheKey = featureCache.getCacheKey(ChrPositions, ChrMvals, 
+											NumWindowsList, WindowSizesList)
+		FeatureArrayList, MissingMask = featureCache.lookupFeatures(CacheDirectory,
+										CacheKey, TSS, MinusStrand, NumFeaturesList)
+		print("\tCached promoters: "+str((~MissingMask).sum())+"/"+\
+				str(MissingMask.shape[0]))
+		if MissingMask.any():
+			NewFeatureArrayList = computeFeatures(MissingMask)
+			for FeatureArray, NewFeatureArray in zip(FeatureArrayList, 
+													NewFeatureArrayList):
+				FeatureArray[MissingMask] = NewFeatureArray
+			CacheUpdate = (CacheDirectory, CacheKey, TSS[MissingMask],
+							MinusStrand[MissingMask], NewFeatureArrayList)
+			if CacheUpdateList is None:
+				featureCache.updateCache(*CacheUpdate)
+			else:
+				# written later by the caller
+				CacheUpdateList.append(CacheUpdate)
+	else:
+		FeatureArrayList = computeFeatures(AllPromoters)
+	print("\tTime to compute Windows: ", time.time()-T2)
+	# 5) build corresponding feature names (WindowSize, Window, Feature)
+	FeatureDFList = [pd.DataFrame(FeatureArray, index=ChrPromoterDF.index,
+									columns=buildHeader(NumWindows, WindowSize)) \
+						for NumWindows, WindowSize, FeatureArray in \
+							zip(NumWindowsList, WindowSizesList, FeatureArrayList)]
+	return pd.concat([ChrPromoterDF] + FeatureDFList, axis=1)
+
+#------------------------------------------------------------------------------
+# 7)
+def runFeaturePool(PrefixSums, BoundaryIdxList, MinusStrand, NumWorkers, 
+					BatchSize):
+	#--------------------------------------------------------------------------
+	# 7.1)
+	def toSharedArray(Array):
+		# copy into (anonymous) shared memory, inherited by the workers
+		Array = np.ascontiguousarray(Array)
+		SharedArray = RawArray(ctypes.c_char, Array.nbytes)
+		np.frombuffer(SharedArray, dtype=Array.dtype)[:] = Array.ravel()
+		return SharedArray, Array.dtype.str, Array.shape
+
+	#--------------------------------------------------------------------------
+	CountPrefix, SumPrefix, SquarePrefix, Shift = PrefixSums
+	# the chromosome's arrays are placed in shared memory once, workers are 
+	# only handed promoter index ranges
+	SharedArrays = {"CountPrefix":toSharedArray(CountPrefix),
+					"SumPrefix":toSharedArray(SumPrefix),
+					"SquarePrefix":toSharedArray(SquarePrefix),
+					"MinusStrand":toSharedArray(MinusStrand)}
+	for WinIdx, BoundaryIdx in enumerate(BoundaryIdxList):
+		SharedArrays["BoundaryIdx"+str(WinIdx)] = toSharedArray(BoundaryIdx)
+	NumPromoters = MinusStrand.shape[0]
+	Tasks = [(Start, min(Start+BatchSize, NumPromoters), len(BoundaryIdxList), 
+				Shift) for Start in range(0, NumPromoters, BatchSize)]
+	FeatureArrayList = [np.empty((NumPromoters, 4*(BoundaryIdx.shape[1]-1))) \
+						for BoundaryIdx in BoundaryIdxList]
+	with multiprocessing.Pool(processes=NumWorkers, initializer=initFeatureWorker,
+								initargs=(SharedArrays,)) as WorkerPool:
+		for Start, Stop, FeatureBatchList in \
+							WorkerPool.imap_unordered(getFeatureBatch, Tasks):
+			for FeatureArray, FeatureBatch in zip(FeatureArrayList, FeatureBatchList):
+				FeatureArray[Start:Stop] = FeatureBatch
+	return FeatureArrayList
+
+#------------------------------------------------------------------------------
+# 7.2)
+def initFeatureWorker(SharedArrays):
+	# numpy views onto the shared chromosome arrays, no copies
+	global WorkerArrays
+	WorkerArrays = {Name:np.frombuffer(SharedArray, dtype=DType).reshape(Shape) \
+					for Name, (SharedArray, DType, Shape) in SharedArrays.items()}
+
+#------------------------------------------------------------------------------
+# 7.3)
+def getFeatureBatch(Task):
+	Start, Stop, NumResolutions, Shift = Task
+	PrefixSums = (WorkerArrays["CountPrefix"], WorkerArrays["SumPrefix"],
+					WorkerArrays["SquarePrefix"], Shift)
+	BoundaryIdxList = [WorkerArrays["BoundaryIdx"+str(WinIdx)][Start:Stop] \
+						for WinIdx in range(NumResolutions)]
+	FeatureBatchList = getFeatures(BoundaryIdxList, 
+								WorkerArrays["MinusStrand"][Start:Stop], PrefixSums)
+	return Start, Stop, FeatureBatchList
+
+#------------------------------------------------------------------------------
+# 8)
+def getPromoterGeometry(PromoterDF, NumWindowsList, WindowSizesList):
+	# promoter regions and window boundaries by chromosome; they do not depend
+	# on the methylome, so are computed once and shared by every sample
+	GeometryDict = {}
+	for Chr in PromoterDF["Chr"].unique():
+		ChrPromoterDF = PromoterDF[PromoterDF["Chr"]==Chr]
+		RegionStartList, WindowRangesList = [], []
+		for NumWindows, WindowSize in zip(NumWindowsList, WindowSizesList):
+			# 2) define feature regions
+			RegionStart, _ = getFeatureRegionDelimiters(ChrPromoterDF, NumWindows, 
+														WindowSize)
+			RegionStartList.append(RegionStart)
+			# 3) generate window ranges for feature calculations
+			WindowRangesList.append(computeWindowRanges(NumWindows, WindowSize))
+		GeometryDict[Chr] = {"PromoterDF":ChrPromoterDF,
+					# methylation chrom IDs carry no "chr" prefix
+					"MethylChr":str(Chr).replace("chr",""),
+					"TSS":getTSS(ChrPromoterDF),
+					"MinusStrand":ChrPromoterDF["Strand"].values.astype(str) != "+",
+					"RegionStartList":RegionStartList,
+					"WindowRangesList":WindowRangesList}
+	return GeometryDict
+
+#------------------------------------------------------------------------------
+# 9)
+def getSampleFeatures(MethylFilePath, GeometryDict, NumWindowsList, 
+						WindowSizesList, NumWorkers, LineArgs, CpGIdx=None):
+	# 1) stream methylation data one chromosome at a time, iterate over Chrs
+	ChrResultsDFDict = {}
+	# feature cache entries, written once the whole file is read: a chromosome
+	# yielded again by the spill fallback (1b) replaces its partial slice's
+	ChrCacheUpdateDict = {}
+	for MethylChr, ChrPositions, ChrMvals in iterMethylDataByChr(MethylFilePath, 
+										LineArgs.chunkSize, LineArgs.spillDirectory,
+										LineArgs.compact):
+		for Chr, ChrGeometry in GeometryDict.items():
+			if ChrGeometry["MethylChr"] != MethylChr:
+				continue
+			print("Processing Features for: "+str(Chr))
+			T1 = time.time()
+			ChrCacheUpdateDict[Chr] = []
+			ChrResultsDFDict[Chr] = getChrFeatures(ChrGeometry, ChrPositions, 
+										ChrMvals, NumWindowsList, WindowSizesList,
+										NumWorkers, LineArgs.batchSize,
+										LineArgs.cacheDirectory, CpGIdx,
+										ChrCacheUpdateDict[Chr])
+			# report time taken for one chr
+			T4 = time.time()
+			Time1 = T4 - T1
+			print("\tTime to complete "+str(Chr)+", "+str(Time1)+"s")
+	for CacheUpdateList in ChrCacheUpdateDict.values():
+		for CacheUpdate in CacheUpdateList:
+			featureCache.updateCache(*CacheUpdate)
+	# promoters on chromosomes without methylation data, all windows np.nan
+	for Chr, ChrGeometry in GeometryDict.items():
+		if Chr not in ChrResultsDFDict:
+			print("Processing Features for: "+str(Chr)+" (no methylation data)")
+			ChrResultsDFDict[Chr] = getChrFeatures(ChrGeometry, 
+										np.empty(0, dtype=np.int64), np.empty(0), 
+										NumWindowsList, WindowSizesList, 1, 
+										LineArgs.batchSize)
+	# concat results DFs, chromosomes in order of first appearance in the
+	# promoter file
+	return pd.concat([ChrResultsDFDict[Chr] for Chr in GeometryDict], axis=0)
+
+#------------------------------------------------------------------------------
+# 10)
+def readManifest(ManifestPath):
+	# MethylFilePath[\tOutFileName] per line, relative paths are relative to
+	# the manifest
+	ManifestDir = os.path.dirname(os.path.abspath(ManifestPath))
+	MethylFilePathList = []
+	OutFileNameList = []
+	with open(ManifestPath) as ManifestFile:
+		for Line in ManifestFile:
+			Fields = Line.rstrip("\n").split("\t")
+			if not Fields[0].strip() or Fields[0].startswith("#"):
+				continue
+			MethylFilePathList.append(os.path.join(ManifestDir, Fields[0].strip()))
+			OutFileNameList.append(Fields[1].strip() \
+				if len(Fields) > 1 and Fields[1].strip() else None)
+	return MethylFilePathList, OutFileNameList
+
+#------------------------------------------------------------------------------
+# 11)
+def writeFeatureTensor(SampleFeatureDF, NumWindowsList, WindowSizesList, 
+						OutputFilePath, FeatureDtype="float32"):
+	# (N,R,W,F) float32, the layout 3_Combine.py builds from the text table
+	FeatureCols = [Col for NumWindows, WindowSize in \
+						zip(NumWindowsList, WindowSizesList) \
+					for Col in buildHeader(NumWindows, WindowSize)]
+	MetaCols = [Col for Col in list(SampleFeatureDF) if Col not in FeatureCols]
+	FeatureNames = ["_".join(Col.split("_")[-2:]) for Col in FeatureCols[:4]]
+	FeatureOrder = np.argsort(FeatureNames)
+	Reshape = (SampleFeatureDF.shape[0], len(WindowSizesList), NumWindowsList[0], 
+				len(FeatureNames))
+	FeatureArray = SampleFeatureDF[FeatureCols].values.astype(FeatureDtype)
+	FeatureArray = FeatureArray.reshape(Reshape)[:,:,:,FeatureOrder]
+	with h5py.File(OutputFilePath, mode="w") as HDF5_File:
+		FeatureInput = HDF5_File.create_dataset("FeatureInput", data=FeatureArray,
+												chunks=True)
+		FeatureInput.attrs["WindowSizes"] = np.array(WindowSizesList)
+		FeatureInput.attrs["NumWindows"] = NumWindowsList[0]
+		FeatureInput.attrs["Features"] = np.array(FeatureNames, 
+												dtype=bytes)[FeatureOrder]
+		for Meta in MetaCols:
+			HDF5_File.create_dataset(Meta, 
+								data=SampleFeatureDF[Meta].astype(str).values.astype(bytes))
+
 #------------------------------------------------------------------------------
 def main(LineArgs):
 	T0 = time.time()
 	# variable input
-	MethylFilePath = LineArgs.MethylFilePath
-	# hard coded input, subject to change:
-	NumWindows = 20
-	WindowSizesList = [250, 2500]
+	if LineArgs.cohort:
+		MethylFilePathList, OutFileNameList = readManifest(LineArgs.MethylFilePath)
+	else:
+		MethylFilePathList = [LineArgs.MethylFilePath]
+		OutFileNameList = [LineArgs.outFileName]
+	# window configuration, one entry per resolution
+	NumWindowsList = LineArgs.numWindows
+	WindowSizesList = LineArgs.windowSizes
 	PromoterDefinitionPath = LineArgs.PromoterDefinitions #"../0_PromoterDefinitions/output/2_Promoter_Definitions_hg19.txt"
-	# 1) load methylation data
-	MethylDF = getMethylData(MethylFilePath)
+	# never run more workers than the CPUs we are allowed to use
+	NumWorkers = min(LineArgs.nbWorkers, getAvailableCpus())
+	print("Using "+str(NumWorkers)+" worker processes")
 	# load promoter definitions from file
-	PromoterDF = pd.read_csv(PromoterDefinitionPath, header="infer",sep="\t")
-	# Iterate over Chrs
-	ChrResultsDFList = []
-	for Chr in PromoterDF["Chr"].unique():
-		print("Processing Features for: "+str(Chr))
-		T1 = time.time()
-		ChrPromoterDF = PromoterDF[PromoterDF["Chr"]==Chr]
-		# iterate over window sizes to generate corresponding features
-		ChrMethylDF = getMethylDataByChr(MethylDF, Chr)
-		for WindowSize in WindowSizesList:
-			T2 = time.time()
-			print("\tWindow: "+str(WindowSize))
-			# 2) define feature regions
-			PromoterRegionDF = getFeatureRegionDelimiters(ChrPromoterDF, NumWindows, 
-															WindowSize)
-			# 3) generate window ranges for feature calculations
-			WindowRanges = computeWindowRanges(NumWindows, WindowSize)
-			# 4) generate features by promoter, for a given window size:
-			ChrPromoterDF["FeatureOutput"] = PromoterRegionDF.parallel_apply(getFeatures, 
-											args=(ChrMethylDF, WindowRanges), axis=1)
-			T3 = time.time()
-			print("\tTime to compute Window: ", T3-T2)
-			# 5) build corresponding feature names (WindowSize, Window, Feature)
-			Header = buildHeader(NumWindows, WindowSize)
-			# split feature signal into separate signal types
-			ChrPromoterDF[Header] = pd.DataFrame(ChrPromoterDF.FeatureOutput.values.tolist(), 
-										index=ChrPromoterDF.index)
-			# remove unparsed col "FeatureOutput"
-			ChrPromoterDF.drop(["FeatureOutput", "FeatureRegionStart","FeatureRegionEnd"], 
-							inplace=True, axis=1)
-		ChrResultsDFList.append(ChrPromoterDF)
-		# report time taken for one chr
-		T4 = time.time()
-		Time1 = T4 - T1
-		print("\tTime to complete "+str(Chr)+", "+str(Time1)+"s")
+	PromoterDF = pd.read_csv(PromoterDefinitionPath, header="infer",sep="\t",
+				dtype={"Chr":"category", "Strand":"category"} if LineArgs.compact else None)
+	# 2), 3) promoter and window boundaries, shared by all samples
+	GeometryDict = getPromoterGeometry(PromoterDF, NumWindowsList, WindowSizesList)
+	# CpG offsets of the window boundaries, shared by samples with the same CpGs
+	CpGIdx = None
+	if LineArgs.cpgIndex:
+		if os.path.exists(LineArgs.cpgIndex):
+			CpGIdx = cpgIndex.CpGIndex.load(LineArgs.cpgIndex)
+			if not CpGIdx.hasConfig(WindowSizesList, NumWindowsList):
+				raise ValueError("CpG index "+LineArgs.cpgIndex+" was built for other windows: "+\
+							str(list(zip(CpGIdx.WindowSizesList, CpGIdx.NumWindowsList))))
+		else:
+			CpGIdx = cpgIndex.CpGIndex(WindowSizesList, NumWindowsList)
 	# completed features printed to file
-	OutputFilePath = LineArgs.outDirectory
 	if not os.path.exists(LineArgs.outDirectory):
 		os.mkdir(LineArgs.outDirectory)
-
-	if not LineArgs.outFileName:
-		OutputFilePath += "/" + "_".join(["Features", MethylFilePath.split("/")[-1]])
-	else:
-		OutputFilePath += "/" + LineArgs.outFileName
-
-	print ("Printing to file", OutputFilePath)
-	# concat results DFs
-	PromoterDF = pd.concat(ChrResultsDFList, axis=0)
-	PromoterDF.to_csv(OutputFilePath, header=True, sep="\t",index=False)
-	# report total time to generate feature for a given chromosome
+	OutputFileNameList = []
+	for MethylFilePath, OutFileName in zip(MethylFilePathList, OutFileNameList):
+		if not OutFileName:
+			OutFileName = "_".join(["Features", 
+							os.path.basename(os.path.normpath(MethylFilePath))])
+			if LineArgs.outFormat == "h5":
+				# .m2f, distinct from the .h5 written by 3_Combine.py
+				OutFileName = os.path.splitext(OutFileName)[0]+".m2f"
+		OutputFileNameList.append(OutFileName)
+	DuplicateNames = sorted(set([OutputFileName for OutputFileName in OutputFileNameList \
+						if OutputFileNameList.count(OutputFileName) > 1]))
+	if DuplicateNames:
+		raise ValueError("Several samples in the manifest would be written to "+\
+						", ".join(DuplicateNames)+"; name their outputs in a "+\
+						"second manifest column")
+	for MethylFilePath, OutputFileName in zip(MethylFilePathList, OutputFileNameList):
+		print("Processing sample: "+MethylFilePath)
+		SampleFeatureDF = getSampleFeatures(MethylFilePath, GeometryDict, 
+										NumWindowsList, WindowSizesList, 
+										NumWorkers, LineArgs, CpGIdx)
+		if CpGIdx is not None and CpGIdx.Modified:
+			print("Saving CpG index", LineArgs.cpgIndex)
+			CpGIdx.save(LineArgs.cpgIndex)
+		OutputFilePath = LineArgs.outDirectory + "/" + OutputFileName
+		print ("Printing to file", OutputFilePath)
+		if LineArgs.outFormat == "h5":
+			writeFeatureTensor(SampleFeatureDF, NumWindowsList, WindowSizesList,
+								OutputFilePath, LineArgs.featureDtype)
+		else:
+			SampleFeatureDF.to_csv(OutputFilePath, header=True, sep="\t",index=False)
+	# report total time to generate features for all samples
 	T3 = time.time()
 	TotalTime = T3 - T0
 	print ("Total time to complete,",str(TotalTime)+"s")
 
-#------------------------------------------------------------------------------
-def clean():
-	for child in psutil.Process(os.getpid()).children(recursive=True):
-		if child.name() == "plasma-store-server":
-			child.kill()
-			
-#------------------------------------------------------------------------------
-
 # Capture command line args, with or without defaults
 if __name__ == '__main__':
-	LineArgs = parseArguments()
-	print("Intializing "+str(LineArgs.nbWorkers)+" threads")
-	par = pandarallel.initialize(nb_workers=LineArgs.nbWorkers)
 	# Parse the arguments
+	LineArgs = parseArguments()
 	main(LineArgs)
-	# Clean up the plasma server
-	clean()
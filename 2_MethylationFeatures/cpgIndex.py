@@ -0,0 +1,137 @@
+'''
+Purpose:
+Reusable, array-backed CpG index: the sorted CpG positions of each chromosome
+and, for every promoter TSS, the CpG offsets of its window boundaries at every
+resolution. Built by 2_getMethylationV2.py (--cpgIndex) and reused by any run,
+or analysis script, on methylomes with the same CpG positions.
+
+General Notes:
+The index is a directory holding:
+	windows.txt, tab delimited window configuration (WindowSize, NumWindows)
+	index.txt, tab delimited chromosome file index (chrom, file)
+	<n>.npz, one per chromosome:
+		Positions, int32 sorted CpG positions
+		TSS, int64 sorted promoter TSSs
+		Offsets<k>, int32 (TSS, NumWindows+1) for resolution k: window i of a
+			promoter spans CpGs [Offsets[p,i], Offsets[p,i+1]) of Positions,
+			windows ordered by genomic position (W-10...W10 on the + strand)
+
+Offsets depend on the TSS only, the strand just reverses window order. They
+are reused only when a chromosome's positions are identical to the indexed ones.
+
+Example (analysis script):
+	Index = cpgIndex.CpGIndex.load("output/hg19.cpgidx")
+	Positions = Index.getPositions("1")
+	OffsetsList = Index.getChrOffsets("1", TSSArray)
+	# CpGs of promoter p in window i at the first resolution
+	Positions[OffsetsList[0][p,i]:OffsetsList[0][p,i+1]]
+'''
+
+import os
+import numpy as np
+import pandas as pd
+
+WindowsFile = "windows.txt"
+IndexFile = "index.txt"
+
+#------------------------------------------------------------------------------
+class CpGIndex(object):
+	def __init__(self, WindowSizesList, NumWindowsList):
+		self.WindowSizesList = [int(w) for w in WindowSizesList]
+		self.NumWindowsList = [int(n) for n in NumWindowsList]
+		# Chr: {"Positions", "TSS", "OffsetsList"}, or the .npz path until used
+		self.ChrDict = {}
+		self.Modified = False
+
+	#--------------------------------------------------------------------------
+	def hasConfig(self, WindowSizesList, NumWindowsList):
+		return self.WindowSizesList == [int(w) for w in WindowSizesList] and \
+				self.NumWindowsList == [int(n) for n in NumWindowsList]
+
+	#--------------------------------------------------------------------------
+	def getChr(self, Chr):
+		# chromosome arrays, loaded from disk on first use; None if not indexed
+		ChrIndex = self.ChrDict.get(Chr)
+		if isinstance(ChrIndex, str):
+			with np.load(ChrIndex) as ChrFile:
+				ChrIndex = {"Positions":ChrFile["Positions"], "TSS":ChrFile["TSS"],
+							"OffsetsList":[ChrFile["Offsets"+str(k)] \
+									for k in range(len(self.WindowSizesList))]}
+			self.ChrDict[Chr] = ChrIndex
+		return ChrIndex
+
+	#--------------------------------------------------------------------------
+	def getPositions(self, Chr):
+		ChrIndex = self.getChr(Chr)
+		return None if ChrIndex is None else ChrIndex["Positions"]
+
+	#--------------------------------------------------------------------------
+	def getChrOffsets(self, Chr, TSS, Positions=None):
+		# offsets of every TSS given, one (TSS, NumWindows+1) array per
+		# resolution; None if any TSS is not indexed, or if Positions are
+		# given and differ from the indexed ones
+		ChrIndex = self.getChr(Chr)
+		if ChrIndex is None:
+			return None
+		if Positions is not None and \
+				not np.array_equal(ChrIndex["Positions"], Positions):
+			return None
+		TSSIdx = pd.Index(ChrIndex["TSS"]).get_indexer(TSS)
+		if (TSSIdx < 0).any():
+			return None
+		return [Offsets[TSSIdx] for Offsets in ChrIndex["OffsetsList"]]
+
+	#--------------------------------------------------------------------------
+	def addChr(self, Chr, Positions, TSS, OffsetsList):
+		# offsets of TSSs already indexed on the same positions are kept,
+		# a chromosome with new positions is replaced
+		ChrIndex = self.getChr(Chr)
+		if ChrIndex is not None and \
+				np.array_equal(ChrIndex["Positions"], Positions):
+			TSS = np.concatenate([ChrIndex["TSS"], TSS])
+			OffsetsList = [np.concatenate([IndexedOffsets, Offsets]) \
+							for IndexedOffsets, Offsets in \
+								zip(ChrIndex["OffsetsList"], OffsetsList)]
+		# one row per TSS
+		TSS, UniqueIdx = np.unique(TSS, return_index=True)
+		self.ChrDict[Chr] = {"Positions":np.asarray(Positions, dtype=np.int32),
+							"TSS":TSS.astype(np.int64),
+							"OffsetsList":[Offsets[UniqueIdx].astype(np.int32) \
+											for Offsets in OffsetsList]}
+		self.Modified = True
+
+	#--------------------------------------------------------------------------
+	def save(self, IndexPath):
+		if not os.path.exists(IndexPath):
+			os.mkdir(IndexPath)
+		# everything in memory before any file of the index is rewritten
+		ChrIndexList = [self.getChr(Chr) for Chr in self.ChrDict]
+		FileList = []
+		for FileIdx, ChrIndex in enumerate(ChrIndexList):
+			Arrays = {"Offsets"+str(k):Offsets \
+						for k, Offsets in enumerate(ChrIndex["OffsetsList"])}
+			FileList.append(str(FileIdx)+".npz")
+			# written aside then renamed, never leaves a partial file
+			TempPath = os.path.join(IndexPath, FileList[-1]+".tmp")
+			with open(TempPath, "wb") as ChrFile:
+				np.savez(ChrFile, Positions=ChrIndex["Positions"],
+							TSS=ChrIndex["TSS"], **Arrays)
+			os.replace(TempPath, os.path.join(IndexPath, FileList[-1]))
+		pd.DataFrame({"WindowSize":self.WindowSizesList,
+						"NumWindows":self.NumWindowsList}).to_csv(
+			os.path.join(IndexPath, WindowsFile), header=True, sep="\t", index=False)
+		pd.DataFrame({"chrom":list(self.ChrDict), "file":FileList}).to_csv(
+			os.path.join(IndexPath, IndexFile), header=True, sep="\t", index=False)
+		self.Modified = False
+
+	#--------------------------------------------------------------------------
+	@classmethod
+	def load(cls, IndexPath):
+		WindowsDF = pd.read_csv(os.path.join(IndexPath, WindowsFile),
+								header="infer", sep="\t")
+		Index = cls(WindowsDF["WindowSize"].values, WindowsDF["NumWindows"].values)
+		IndexDF = pd.read_csv(os.path.join(IndexPath, IndexFile), header="infer",
+								sep="\t", dtype={"chrom":str})
+		for Chr, ChrFile in zip(IndexDF["chrom"], IndexDF["file"]):
+			Index.ChrDict[Chr] = os.path.join(IndexPath, ChrFile)
+		return Index
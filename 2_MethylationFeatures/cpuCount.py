@@ -0,0 +1,38 @@
+'''
+Purpose:
+Number of CPUs a pipeline stage may use, for the default size of its worker
+pool (1_getResponseVariable.py, 2_getMethylationV2.py --nbWorkers).
+
+General Notes:
+os.cpu_count() reports the host's CPUs; inside a container (or with taskset)
+the process may run on fewer. The CPUs of the process affinity are capped by
+any cgroup CPU quota (v2 cpu.max, or v1 cfs quota/period).
+1_ResponseVariable and 2_MethylationFeatures each hold an identical copy, so
+either stage runs without the other's directory; change both together.
+'''
+
+import os
+
+#------------------------------------------------------------------------------
+def getAvailableCpus():
+	# CPUs this process may run on, then capped by any cgroup CPU quota
+	# (v2 cpu.max, or v1 cfs quota/period), which a container does not see
+	# in the host CPU count
+	try:
+		NumCpus = len(os.sched_getaffinity(0))
+	except AttributeError:
+		NumCpus = os.cpu_count() or 1
+	try:
+		with open("/sys/fs/cgroup/cpu.max") as CpuMaxFile:
+			Quota, Period = CpuMaxFile.read().split()[:2]
+	except (OSError, ValueError):
+		try:
+			with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as QuotaFile:
+				Quota = QuotaFile.read().strip()
+			with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as PeriodFile:
+				Period = PeriodFile.read().strip()
+		except OSError:
+			Quota, Period = "max", "1"
+	if Quota not in ("max", "-1"):
+		NumCpus = min(NumCpus, max(1, int(Quota) // int(Period)))
+	return NumCpus
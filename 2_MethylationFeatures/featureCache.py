@@ -0,0 +1,82 @@
+'''
+Purpose:
+Content-addressed cache of per-chromosome window features, so that reruns of
+2_getMethylationV2.py only compute what changed.
+
+General Notes:
+One cache file per (methylation chromosome slice, window configuration):
+	<CacheDirectory>/<sha1>.npz
+where the sha1 covers the chromosome's CpG positions and mvals (raw bytes and
+dtypes), the window sizes and counts, and CacheVersion.
+
+A promoter's features depend only on its TSS and strand once the methylation
+and windows are fixed, so each file stores the features of every (TSS, strand)
+seen so far for that chromosome. Rows of a new promoter definition file are
+matched on (TSS, strand): only promoters not yet cached are computed, and the
+file is then extended with them. A change to the methylome of a chromosome,
+or to the windows, gives a new key and a full recompute of that chromosome.
+'''
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+# bump whenever the feature definitions or rounding change
+CacheVersion = "1"
+
+#------------------------------------------------------------------------------
+def getCacheKey(Positions, Mvals, NumWindowsList, WindowSizesList):
+	Hash = hashlib.sha1()
+	Hash.update(("M2A features v"+CacheVersion).encode())
+	Hash.update(str(list(zip(NumWindowsList, WindowSizesList))).encode())
+	for Array in [Positions, Mvals]:
+		Array = np.ascontiguousarray(Array)
+		Hash.update(Array.dtype.str.encode())
+		Hash.update(Array.view(np.uint8))
+	return Hash.hexdigest()
+
+#------------------------------------------------------------------------------
+def getGeometryCodes(TSS, MinusStrand):
+	# one integer per (TSS, strand), the features of a promoter depend on no more
+	return TSS.astype(np.int64) * 2 + MinusStrand.astype(np.int64)
+
+#------------------------------------------------------------------------------
+def lookupFeatures(CacheDirectory, CacheKey, TSS, MinusStrand, NumFeaturesList):
+	# features of the cached promoters filled in, np.nan elsewhere;
+	# MissingMask flags the promoters still to compute
+	FeatureArrayList = [np.full((TSS.shape[0], NumFeatures), np.nan) \
+						for NumFeatures in NumFeaturesList]
+	MissingMask = np.ones(TSS.shape[0], dtype=bool)
+	CachePath = os.path.join(CacheDirectory, CacheKey+".npz")
+	if not os.path.exists(CachePath):
+		return FeatureArrayList, MissingMask
+	with np.load(CachePath) as Cache:
+		CachedIdx = pd.Index(Cache["Codes"]).get_indexer(
+										getGeometryCodes(TSS, MinusStrand))
+		MissingMask = CachedIdx < 0
+		for WinIdx, FeatureArray in enumerate(FeatureArrayList):
+			FeatureArray[~MissingMask] = Cache["Features"+str(WinIdx)][CachedIdx[~MissingMask]]
+	return FeatureArrayList, MissingMask
+
+#------------------------------------------------------------------------------
+def updateCache(CacheDirectory, CacheKey, TSS, MinusStrand, FeatureArrayList):
+	if not os.path.exists(CacheDirectory):
+		os.makedirs(CacheDirectory)
+	CachePath = os.path.join(CacheDirectory, CacheKey+".npz")
+	Codes = getGeometryCodes(TSS, MinusStrand)
+	if os.path.exists(CachePath):
+		with np.load(CachePath) as Cache:
+			Codes = np.concatenate([Cache["Codes"], Codes])
+			FeatureArrayList = [np.concatenate([Cache["Features"+str(WinIdx)],
+												FeatureArray]) \
+								for WinIdx, FeatureArray in enumerate(FeatureArrayList)]
+	# one row per (TSS, strand)
+	Codes, UniqueIdx = np.unique(Codes, return_index=True)
+	Arrays = {"Features"+str(WinIdx):FeatureArray[UniqueIdx] \
+				for WinIdx, FeatureArray in enumerate(FeatureArrayList)}
+	# written aside then renamed, concurrent runs never read a partial file
+	TempPath = CachePath+"."+str(os.getpid())+".tmp"
+	with open(TempPath, "wb") as CacheFile:
+		np.savez(CacheFile, Codes=Codes, **Arrays)
+	os.replace(TempPath, CachePath)
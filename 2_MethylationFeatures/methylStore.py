@@ -0,0 +1,69 @@
+'''
+Purpose:
+Read and write the binary methylation store, a one-time conversion of the
+tab delimited chrom/pos/mval M-value table that can be memory-mapped directly
+by 2_getMethylationV2.py instead of being parsed again.
+
+General Notes:
+The store is a directory holding:
+	pos.npy, int32 CpG positions, grouped by chromosome and sorted within it
+	mval.npy, float32 M-values matching pos.npy row for row
+	index.txt, tab delimited chromosome offset index:
+		chrom, (chromosome ID, as found in the source file)
+		start, (first row of the chromosome in pos.npy/mval.npy)
+		stop, (one past the last row)
+
+M-values are kept at float32 precision (~7 significant digits), well beyond
+the 3 decimals reported for the window features.
+'''
+
+import os
+import numpy as np
+import pandas as pd
+
+PositionsFile = "pos.npy"
+MvalsFile = "mval.npy"
+IndexFile = "index.txt"
+
+#------------------------------------------------------------------------------
+def isMethylStore(StorePath):
+	return os.path.isdir(StorePath) and \
+			os.path.exists(os.path.join(StorePath, IndexFile))
+
+#------------------------------------------------------------------------------
+def writeMethylStore(MethylDF, StorePath):
+	if not os.path.exists(StorePath):
+		os.mkdir(StorePath)
+	# group by chromosome, positions ascending within each
+	MethylDF = MethylDF.sort_values(by=["chrom","pos"], kind="mergesort")
+	Chroms = MethylDF["chrom"].astype(str).values
+	np.save(os.path.join(StorePath, PositionsFile),
+			MethylDF["pos"].values.astype(np.int32))
+	np.save(os.path.join(StorePath, MvalsFile),
+			MethylDF["mval"].values.astype(np.float32))
+	# offsets of each chromosome's contiguous block of rows
+	ChromList, StartList = np.unique(Chroms, return_index=True)
+	IndexDF = pd.DataFrame({"chrom":ChromList, "start":StartList})
+	IndexDF.sort_values(by=["start"], inplace=True)
+	IndexDF["stop"] = np.append(IndexDF["start"].values[1:], len(Chroms))
+	IndexDF.to_csv(os.path.join(StorePath, IndexFile), header=True, sep="\t",
+					index=False)
+	return IndexDF
+
+#------------------------------------------------------------------------------
+def loadMethylStore(StorePath):
+	# arrays are memory-mapped, only the chromosomes used are paged in
+	IndexDF = pd.read_csv(os.path.join(StorePath, IndexFile), header="infer",
+							sep="\t", dtype={"chrom":str})
+	IndexDF.set_index("chrom", inplace=True, drop=True)
+	Positions = np.load(os.path.join(StorePath, PositionsFile), mmap_mode="r")
+	Mvals = np.load(os.path.join(StorePath, MvalsFile), mmap_mode="r")
+	return IndexDF, Positions, Mvals
+
+#------------------------------------------------------------------------------
+def getStoreChr(MethylStore, Chr):
+	IndexDF, Positions, Mvals = MethylStore
+	if Chr not in IndexDF.index:
+		return Positions[:0], Mvals[:0]
+	Start, Stop = IndexDF.loc[Chr, ["start","stop"]].astype(int)
+	return Positions[Start:Stop], Mvals[Start:Stop]
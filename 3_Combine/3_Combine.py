@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 '''
 Purpose:
-Combine/interleave all features into pseudo image arrays for input to a CNN model
+Combine all features into pseudo image arrays for input to a CNN model
 
 General Notes:
 In the event transfer learning is required, this .h5 file output will also include
-the response variable.
+the response variable (one log2_ChipDivInput_<Mark> dataset per mark, for
+multi-mark response files).
 
 #------------------------------------------------------------------------------
 Input Required:
@@ -22,6 +23,12 @@ Input Required:
 		"End", 
 		"RStart", response variable region start
 		"REnd", response variable region end
+	1C) Or, the float32 feature tensor written by 2_getMethylationV2.py with
+		--outFormat h5 (.m2f); it is read as is, without the text round-trip.
+	Several files (shards, e.g. per chromosome) may be given, all text or all
+	.m2f: their headers (columns, or layout and datasets) must match, and they
+	are read one by one into the tensor, in the order given, replacing the
+	combine.sh concatenation.
 
 #------------------------------------------------------------------------------
 Output:
@@ -40,16 +47,42 @@ An m by n array,
 [[[Features250bp at W-10],[Features250bp at W-9]...[Features250bp at W9][Features250bp at W10]],
 [[Features2500bp at W-10][Features2500bp at W-9]...[Features2500bp at W9][Features2500bp at W10]]]
 
-To do this, both columns and rows are interleaved, then the matrix is reshaped to:
+To do this, the feature columns are selected in (resolution, window, feature)
+order and each promoter row is reshaped to:
 (N,Resolutions,Windows,Features)
 N = 96,757 number of promoters from all chromosomes 
 	(or however many in the file provided)
 Resolutions = 2, or number of windowsizes (250, 2500)
 Windows = 20, windows
-Features = 4, (Ave, Var, SSD, FracSSD)
+Features = 4, (Ave, FracSSD, SSD, Var), sorted on name
+
+Promoters keep the order of the input file, and every meta data dataset is in
+that same order.
 
 Output Notes:
-	All meta data/ positional values are also recorded in hdf5, astype(bytes).
+	All meta data/ positional values are also recorded in hdf5, as one table
+	("MetaData", a compound dataset of variable length strings, one field per
+	column); response variables are float64 datasets.
+	Every dataset is chunked along promoters (--chunkSize, default 512, the
+	prediction batch size), resizable and optionally compressed (--compression
+	gzip, lzf or blosc). --append adds a shard to an existing output file.
+	FeatureInput is float64 by default; --featureDtype float32 halves it (the
+	CNN computes in float32 anyway), float16 quarters it for storage. Scaled
+	features lie in [0, 1], so the absolute error vs float64 is at most ~3e-8
+	(float32) or ~3e-4 (float16); checkPrecision.py measures it for a sample.
+	FeatureInput attrs record the layout (WindowSizes, NumWindows, Features) 
+	and the scaler used (ScalerMin, ScalerMax, (Resolutions,Features)).
+2) With --saveScaler, a JSON file of the scaler min/max per resolution and
+	feature.
+
+Scaling in two passes (shards, e.g. per chromosome):
+	reduce, per shard: --scalerOnly --saveScaler Shard.json
+	apply, per shard:  --scaler Shard1.json Shard2.json ...
+		(with --append into one output file, or one file per shard)
+The merged min/max is that of all shards together, so each shard is scaled as
+in a single run over all of them. Predictions may reuse a training scaler with
+--scaler Training.json (or the training HDF5); values outside the training range
+then fall outside .1-1.
 
 #------------------------------------------------------------------------------
 What if...?
@@ -65,26 +98,110 @@ import h5py
 import argparse
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+import warnings
+import json
 
 #------------------------------------------------------------------------------
 def parseArguments(): 
 	# Create argument parser
 	parser = argparse.ArgumentParser()   
 	# Positional mandatory arguments
-	parser.add_argument("MethylationFilePath", 
-		help="Full path to methylation features file.", type=str)
+	parser.add_argument("MethylationFilePath", nargs="+",
+		help="Full path to methylation features file(s) (tsv, or .m2f tensor); "+\
+		"several shards (e.g. per chromosome) are combined in the order given.", type=str)
 	parser.add_argument("--ResponseVariablePath", help="Full path to response variable file.", type=str)
 	parser.add_argument("--outFileName", help="File name to use for output", type=str)
 	parser.add_argument("--outDirectory", help="Directory to write output to", default="output", type=str)
+	parser.add_argument("--featureDtype", help="Storage dtype of FeatureInput", 
+		choices=["float64","float32","float16"], default="float64", type=str)
+	parser.add_argument("--scaler", help="Scale with saved min/max instead of "+\
+		"the input's: JSON from --saveScaler (several are merged), or a combined HDF5", 
+		nargs="+", type=str)
+	parser.add_argument("--saveScaler", help="Write the min/max used to a JSON file", 
+		type=str)
+	parser.add_argument("--scalerOnly", help="Only compute the scaler (with "+\
+		"--saveScaler), no HDF5 is written", action="store_true")
+	parser.add_argument("--chunkSize", help="Promoters per HDF5 chunk, align "+\
+		"with the prediction batch size", default=512, type=int)
+	parser.add_argument("--compression", help="HDF5 compression (blosc needs "+\
+		"hdf5plugin)", choices=["none","gzip","lzf","blosc"], default="none", type=str)
+	parser.add_argument("--append", help="Append to the output HDF5 if it "+\
+		"exists (shards scaled with the same --scaler)", action="store_true")
 
 	# Parse arguments
 	args = parser.parse_args()
 	return args
 
+#------------------------------------------------------------------------------
+# 0)
+def isFeatureTensor(MethylationFilePath):
+	# .m2f feature tensor from 2_getMethylationV2.py --outFormat h5
+	return h5py.is_hdf5(MethylationFilePath)
+
+#------------------------------------------------------------------------------
+# 0a)
+def getWindowConfig(MethylationFilePath):
+	if isFeatureTensor(MethylationFilePath):
+		with h5py.File(MethylationFilePath, mode="r") as HDF5_File:
+			Attrs = HDF5_File["FeatureInput"].attrs
+			return int(Attrs["NumWindows"]), [int(w) for w in Attrs["WindowSizes"]], \
+					[f.decode() for f in Attrs["Features"]]
+	# resolutions and windows, from the feature names: WindowSize_W#_M_Feature
+	Columns = pd.read_csv(MethylationFilePath, header="infer", sep="\t", 
+							nrows=0).columns
+	FeatureCols = [c for c in Columns if c.split("_")[0].isdigit()]
+	WindowSizeList = []
+	for c in FeatureCols:
+		if int(c.split("_")[0]) not in WindowSizeList:
+			WindowSizeList.append(int(c.split("_")[0]))
+	NumOfWinList = [len(set(c.split("_")[1] for c in FeatureCols \
+						if c.split("_")[0]==str(WindowSize))) \
+					for WindowSize in WindowSizeList]
+	# every resolution is one row of the same "image"
+	if len(set(NumOfWinList)) != 1:
+		raise ValueError("All window sizes need the same number of windows, "+\
+							"found "+str(dict(zip(WindowSizeList, NumOfWinList))))
+	# features sorted on name, the order of the tensor's last axis
+	FeatureList = sorted(set(c.split("_",2)[2] for c in FeatureCols))
+	return NumOfWinList[0], WindowSizeList, FeatureList
+
+#------------------------------------------------------------------------------
+# 0b)
+def checkShardHeaders(MethylationFilePathList):
+	#--------------------------------------------------------------------------
+	# 0b.1)
+	def getShardHeader(MethylationFilePath):
+		# columns of a text shard; layout and datasets of a .m2f shard
+		if isFeatureTensor(MethylationFilePath):
+			with h5py.File(MethylationFilePath, mode="r") as HDF5_File:
+				Attrs = HDF5_File["FeatureInput"].attrs
+				return ["FeatureInput"+str(HDF5_File["FeatureInput"].shape[1:]),
+						"WindowSizes"+str([int(w) for w in Attrs["WindowSizes"]]),
+						"Features"+str([f.decode() for f in Attrs["Features"]])] + \
+						sorted(Dataset for Dataset in HDF5_File)
+		return list(pd.read_csv(MethylationFilePath, header="infer", sep="\t", 
+								nrows=0).columns)
+
+	#--------------------------------------------------------------------------
+	Header = getShardHeader(MethylationFilePathList[0])
+	for MethylationFilePath in MethylationFilePathList[1:]:
+		if isFeatureTensor(MethylationFilePath) != \
+				isFeatureTensor(MethylationFilePathList[0]):
+			raise ValueError("Shards must all be text or all .m2f: "+\
+								MethylationFilePath)
+		ShardHeader = getShardHeader(MethylationFilePath)
+		if ShardHeader == Header:
+			continue
+		Missing = [c for c in Header if c not in ShardHeader]
+		Extra = [c for c in ShardHeader if c not in Header]
+		raise ValueError("Header of "+MethylationFilePath+" differs from "+\
+				MethylationFilePathList[0]+(", missing "+str(Missing[:5]) \
+					if Missing else "")+(", extra "+str(Extra[:5]) if Extra else "")+\
+				("" if Missing or Extra else ", column order differs"))
+
 #------------------------------------------------------------------------------
 # 1)
-def prepMethylationData(MethylationFilePath, WindowSizeList):
+def prepMethylationData(MethylationFilePath):
 	#--------------------------------------------------------------------------
 	# 1.1)
 	def loadData(MethylationFilePath):
@@ -96,182 +213,289 @@ def prepMethylationData(MethylationFilePath, WindowSizeList):
 		MethylationDF.drop(ExtraCols,inplace=True,axis=1)
 		return MethylationDF, MetaDF
 
-	#--------------------------------------------------------------------------
-	# 1.2)
-	def scaleData(MethylationFeatDF):
-		# hard coded parameters, most likely will not change:
-		NewMval = 0
-		OldMval = np.nan
-		MinMval = .1
-		MaxMval = 1
-		#
-		# Note:
-		# The full range of a given feature for a given window size is required
-		# for an accurate scaler, so the feature values are reshaped/flattened.
-		# This requires iteration over unique window size/ feature type.
-		#
-		# Also: not all versions of MinMaxScaler (sklearn '0.20.2') 
-		# ignores np.nans. This functionality is essential for this chunk of 
-		# code,(np.nan masking)
-		#
-		#
-		WindowSizeList = np.unique([c.split("_")[0] \
-											for c in list(MethylationFeatDF)])
-		FeatureTypeList = np.unique(["_".join(c.split("_")[-2:]) \
-											for c in list(MethylationFeatDF)])
-		ScaledFeatDFList = []
-		for WindowSize in WindowSizeList:
-			for FeatureType in FeatureTypeList:
-				FeatureCols = [c for c in list(MethylationFeatDF) if \
-								c.split("_")[0]==str(WindowSize) and \
-								"_".join(c.split("_")[-2:])==FeatureType]
-				TempMethylDF = MethylationFeatDF[FeatureCols]
-				# Scaling
-				MMS = MinMaxScaler(feature_range=(MinMval,MaxMval))
-				NewShape = (np.prod(TempMethylDF.shape),1)
-				ReshapedMethylArray = TempMethylDF.values.reshape(NewShape)
-				MMS.fit(ReshapedMethylArray)
-				ScaledFeatDF = pd.DataFrame(MMS.transform(TempMethylDF),
-												columns=TempMethylDF.columns)
-				ScaledFeatDF.index = MethylationFeatDF.index
-				ScaledFeatDFList.append(ScaledFeatDF)
-		#--------------------------------------------
-		ScaledMethylDF = pd.concat(ScaledFeatDFList,axis=1)
-		ScaledMethylDF.replace(OldMval,NewMval,inplace=True)
-		return ScaledMethylDF
-
 	#-------------------------------------------------------------------------#
 	# load data and drop extraneous fields, set index
 	MethylationFeatDF, MetaDF = loadData(MethylationFilePath)
-	# scale DFs from 0-1, replace np.nan with 0
-	ScaledMethylDF = scaleData(MethylationFeatDF)
-	return ScaledMethylDF, MetaDF
+	return MethylationFeatDF, MetaDF
 	
+#------------------------------------------------------------------------------
+# 1b)
+def prepFeatureTensor(MethylationFilePath):
+	#--------------------------------------------------------------------------
+	# 1b.1)
+	def loadData(MethylationFilePath):
+		with h5py.File(MethylationFilePath, mode="r") as HDF5_File:
+			FeatureArray = HDF5_File["FeatureInput"][:].astype(np.float64)
+			MetaDF = pd.DataFrame({Meta:HDF5_File[Meta][:].astype(str) \
+							for Meta in HDF5_File if Meta != "FeatureInput"})
+		MetaDF.set_index("EnsmblID_T", inplace=True, drop=False)
+		return FeatureArray, MetaDF
+
+	#-------------------------------------------------------------------------#
+	FeatureArray, MetaDF = loadData(MethylationFilePath)
+	print("ReshapedImageArray", FeatureArray.shape)
+	return FeatureArray, MetaDF
+
+#------------------------------------------------------------------------------
+# 1c)
+def iterFeatureShards(MethylationFilePathList, NumOfWin, WindowSizeList):
+	# (N,R,W,F) float64 array and MetaDF of each shard, in the order given
+	for MethylationFilePath in MethylationFilePathList:
+		print("Shard:", MethylationFilePath)
+		if isFeatureTensor(MethylationFilePath):
+			# 1b) tensor is already (N,R,W,F): load as is
+			ReshapedImageArray, MetaDF = prepFeatureTensor(MethylationFilePath)
+		else:
+			# 1) prep methylation for stacking feature arrays:
+			# 1.1) load data, slice extraneous columns into MetaData DF:
+			#		positional, gene/transcript IDs, etc.
+			MethylationFeatDF, MetaDF = prepMethylationData(MethylationFilePath)
+			# 2) Combines data into reshaped arrays for CNN model input
+			# 2.1) Get column order (resolution, window, feature), then reshape
+			ReshapedImageArray = getFeatureArray(MethylationFeatDF, NumOfWin, 
+																WindowSizeList)
+			del MethylationFeatDF
+		yield ReshapedImageArray.astype(np.float64), MetaDF
+
 #------------------------------------------------------------------------------
 # 2)
-def runCombineDataPipeline(ScaledMethylDF, NumOfWin, WindowSizeList):
+def getFeatureArray(MethylationFeatDF, NumOfWin, WindowSizeList):
 	#-------------------------------------------------------------------------#
 	# 2.1)
-	def splitOnWindowSize(ScaledMethylDF, WindowSizeList):
-		WindowSizeMethylDFList = []
-		for WindowSize in WindowSizeList:
-			FeatureCols = [c for c in list(ScaledMethylDF) \
-										if c.split("_")[0]==str(WindowSize)]
-			WindowSizeMethylDF = ScaledMethylDF[FeatureCols]
-			WindowSizeMethylDF.columns = ["_".join(c.split("_")[1:]) \
-										for c in list(WindowSizeMethylDF)]
-			WindowSizeMethylDFList.append(WindowSizeMethylDF)
-		return WindowSizeMethylDFList
+	def getColumnOrder(MethylationFeatDF, WindowSizeList):
+		# feature names: WindowSize_W#_M_Feature, windows and features are the
+		# same for every resolution, taken from the first one
+		FeatureCols = [c.split("_",1)[1] for c in list(MethylationFeatDF) \
+								if c.split("_")[0]==str(WindowSizeList[0])]
+		WindowList = sorted(set(c.split("_")[0] for c in FeatureCols),
+							key=lambda x: int(x.replace("W","")))
+		FeatList = sorted(set(c.split("_",1)[1] for c in FeatureCols))
+		# (R,W,F) order, resolution major
+		ColumnOrder = [str(WindowSize)+"_"+Window+"_"+Feat \
+							for WindowSize in WindowSizeList \
+								for Window in WindowList for Feat in FeatList]
+		return ColumnOrder, len(FeatList)
 
 	#-------------------------------------------------------------------------#
-	# 2.2)
-	def interleaveCols(WindowSizeMethylDFList, NumOfWin, WindowSizeList):
-		#---------------------------------------------------------------------#
-		# 2.2.1)
-		def getFeatOrder(Window250bpDF, NumOfWin):
-			DF_Feat_List = list(Window250bpDF)
-			# sort on window number:
-			SortedFeatList = sorted(DF_Feat_List, 
-							key=lambda x: int(x.split("_")[0].replace("W","")))
-			TotalNumFeatures = len(DF_Feat_List)
-			FeatPerWindow = int(TotalNumFeatures / NumOfWin)
-			WindowFeatList = [SortedFeatList[i:i+FeatPerWindow] \
-							for i in range(0,TotalNumFeatures,FeatPerWindow)]			
-			FeatOrder = [sorted(i,key=lambda x:"_".join(x.split("_")[1:]))\
-								for i in WindowFeatList]
-			FeatOrder = np.array(FeatOrder).flatten().tolist()
-			return FeatOrder
-
-		#---------------------------------------------------------------------#
-		# FeatureCols are the same between WindowSizeDFs, feature order should
-		# be the same for both:
-		Window250bpDF = WindowSizeMethylDFList[0]
-		FeatureOrder = getFeatOrder(Window250bpDF, NumOfWin)
-		# iterate over each WindowSize DF and reorder features
-		InterleaveDFList = []
-		for WinIdx, WindowSizeMethylDF in enumerate(WindowSizeMethylDFList):
-			# reorder these columns
-			InterleaveDF = WindowSizeMethylDF[FeatureOrder]
-			# Adjust index for row interleaving/sorting later
-			# NOTE: only required for multiple resolutions
-			InterleaveDF.index = InterleaveDF.index+"_"+str(WinIdx)
-			print("Col Interleave "+str(WindowSizeList[WinIdx])+\
-					" Resolution shape:", InterleaveDF.shape)
-			InterleaveDFList.append(InterleaveDF)
-		return InterleaveDFList
+	# one row per promoter, in file order: selecting the columns in (R,W,F)
+	# order makes each row one flattened "image"
+	ColumnOrder, NumFeat = getColumnOrder(MethylationFeatDF, WindowSizeList)
+	Reshape = (MethylationFeatDF.shape[0], len(WindowSizeList), NumOfWin, NumFeat)
+	print("Using Reshape Values:", str(Reshape))
+	ReshapedImageArray = MethylationFeatDF[ColumnOrder].values.reshape(Reshape)
+	print("ReshapedImageArray", ReshapedImageArray.shape)
+	return ReshapedImageArray
 
-	#-------------------------------------------------------------------------#
-	# 2.3)
-	def interleaveRows(InterleavedColDFList):
-		InterleavedRowDF = pd.concat(InterleavedColDFList, axis=0).sort_index()
-		print("Example DF Row Interleaved,\n", InterleavedRowDF.iloc[:9])
-		return InterleavedRowDF
+#------------------------------------------------------------------------------
+# 2b)
+def getScalerParams(FeatureArray):
+	# Note:
+	# The full range of a given feature for a given window size is required
+	# for an accurate scaler: min/max over all promoters and windows of each 
+	# (resolution, feature), ignoring np.nan. (R,F) arrays; the min/max of
+	# shards combine into the min/max of the whole, see mergeScalerParams.
+	with warnings.catch_warnings():
+		# an all np.nan resolution/ feature stays np.nan, then 0
+		warnings.simplefilter("ignore", category=RuntimeWarning)
+		DataMin = np.nanmin(FeatureArray, axis=(0,2))
+		DataMax = np.nanmax(FeatureArray, axis=(0,2))
+	return DataMin, DataMax
 
-	#-------------------------------------------------------------------------#
-	# 2.4)
-	def reshapeDF(InterleavedDF, NumOfWin, WindowSizeList):
-		# USING: (n,2,20,4), (N,R,W,1,Wcols)
-		R = len(WindowSizeList) # num of window sizes, resolutions
-		N = int(InterleavedDF.shape[0] / R) # number of "images", promoters
-		W = NumOfWin # number of windows
-		Wcols = int(InterleavedDF.shape[1] / W) # pixel channels
-		Reshape = (N,R,W,Wcols)
-		print("Using Reshape Values:", str(Reshape))
-		# Reshape and return...
-		ReshapedImageArray = InterleavedDF.values.reshape(Reshape)
-		print("ReshapedImageArray", ReshapedImageArray.shape)
-		return ReshapedImageArray
+#------------------------------------------------------------------------------
+# 2c)
+def mergeScalerParams(ScalerList):
+	# ScalerList of (DataMin, DataMax), one per shard
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore", category=RuntimeWarning)
+		DataMin = np.nanmin(np.stack([Scaler[0] for Scaler in ScalerList]), axis=0)
+		DataMax = np.nanmax(np.stack([Scaler[1] for Scaler in ScalerList]), axis=0)
+	return DataMin, DataMax
 
-	#-------------------------------------------------------------------------#
-	# split methylationDF into separate window sizes/ resolutions for 
-	# interleaving
-	WindowSizeMethylDFList = splitOnWindowSize(ScaledMethylDF, WindowSizeList)
-	# interleave features, or columns		
-	InterleavedColDFList = interleaveCols(WindowSizeMethylDFList, 
-											NumOfWin, 
-											WindowSizeList)
-	InterleavedDF = interleaveRows(InterleavedColDFList)
-	ReshapedImageArray = reshapeDF(InterleavedDF, NumOfWin, WindowSizeList)
-	return ReshapedImageArray, InterleavedDF.index
+#------------------------------------------------------------------------------
+# 2d)
+def saveScaler(ScalerFilePath, DataMin, DataMax, WindowSizeList, FeatureList):
+	# np.nan (no value in any promoter) is written as null
+	ScalerDict = {"WindowSizes":[int(w) for w in WindowSizeList],
+					"Features":list(FeatureList),
+					"DataMin":[[None if np.isnan(v) else float(v) for v in Row] \
+								for Row in DataMin],
+					"DataMax":[[None if np.isnan(v) else float(v) for v in Row] \
+								for Row in DataMax]}
+	with open(ScalerFilePath, "w") as ScalerFile:
+		json.dump(ScalerDict, ScalerFile, indent=1)
+	print("Saved scaler:", ScalerFilePath)
 
 #------------------------------------------------------------------------------
-# 4)
-def sortMetaDF(SortedIndex, MetaDF):
-	#--------------------------------------------------------------------------
-	# 4.1)
-	def processIdx(SortedIndex):
-		# retrieving unique index, removing resolution level data
-		IDX = pd.DataFrame(SortedIndex.str.split("_").tolist(), 
-														columns = ["1","2"])
-		return IDX["1"].unique()
-	#--------------------------------------------------------------------------
-	FinalIndex = processIdx(SortedIndex)
-	NewMetaDF = MetaDF.loc[FinalIndex]
-	return NewMetaDF
+# 2e)
+def loadScaler(ScalerFilePath, WindowSizeList, FeatureList):
+	# a JSON file from --saveScaler, or a combined HDF5 (attrs of FeatureInput)
+	if h5py.is_hdf5(ScalerFilePath):
+		with h5py.File(ScalerFilePath, mode="r") as HDF5_File:
+			Attrs = HDF5_File["FeatureInput"].attrs
+			if "ScalerMin" not in Attrs:
+				raise ValueError("No scaler recorded in "+ScalerFilePath)
+			ScalerDict = {"WindowSizes":[int(w) for w in Attrs["WindowSizes"]],
+							"Features":[f.decode() for f in Attrs["Features"]],
+							"DataMin":Attrs["ScalerMin"], "DataMax":Attrs["ScalerMax"]}
+	else:
+		with open(ScalerFilePath) as ScalerFile:
+			ScalerDict = json.load(ScalerFile)
+	# the same (resolution, feature) layout, or the scaler does not apply
+	if ScalerDict["WindowSizes"] != [int(w) for w in WindowSizeList] or \
+			ScalerDict["Features"] != list(FeatureList):
+		raise ValueError("Scaler "+ScalerFilePath+" is for windows "+\
+				str(ScalerDict["WindowSizes"])+" and features "+\
+				str(ScalerDict["Features"])+", input has "+str(WindowSizeList)+\
+				" and "+str(FeatureList))
+	return np.array(ScalerDict["DataMin"], dtype=np.float64), \
+			np.array(ScalerDict["DataMax"], dtype=np.float64)
+
+#------------------------------------------------------------------------------
+# 2f)
+def scaleFeatureArray(FeatureArray, DataMin, DataMax):
+	# hard coded parameters, most likely will not change:
+	NewMval = 0
+	MinMval = .1
+	MaxMval = 1
+	#
+	# Note:
+	# Same arithmetic as sklearn's MinMaxScaler, a constant feature (zero 
+	# range) is scaled as range 1. With a saved scaler (other samples, or 
+	# the whole genome) values of a shard may fall outside .1-1.
+	#
+	DataMin = DataMin[np.newaxis,:,np.newaxis,:]
+	DataRange = DataMax[np.newaxis,:,np.newaxis,:] - DataMin
+	DataRange[DataRange == 0.0] = 1.0
+	Scale = (MaxMval - MinMval) / DataRange
+	# (N,R,W,F) scaled in place, then np.nan replaced
+	FeatureArray *= Scale
+	FeatureArray += MinMval - DataMin * Scale
+	FeatureArray[np.isnan(FeatureArray)] = NewMval
+	return FeatureArray
+
+#------------------------------------------------------------------------------
+# 3)
+def loadResponseVariable(ResponseVariablePath):
+	ResponseVarDF = pd.read_csv(ResponseVariablePath, header="infer",sep="\t")
+	ResponseVarDF.set_index("EnsmblID_T",inplace=True,drop=True)
+	# keeping only the relevant column(s) (response variable, per mark)
+	return ResponseVarDF[[c for c in list(ResponseVarDF) \
+							if c.startswith("log2_ChipDivInput")]]
 
 #------------------------------------------------------------------------------
 # 5)
-def createHDF5(ReshapedImageArray, MetaDF, OutputFilePath):
-	# initial hdf5 file 
-	HDF5_File = h5py.File(OutputFilePath, mode='w')
-	# create "image" feature dataset
-	HDF5_File.create_dataset("FeatureInput", data=ReshapedImageArray)
-	# create response variable dataset
-	if "log2_ChipDivInput" in list(MetaDF):
-		HDF5_File.create_dataset("log2_ChipDivInput", data=MetaDF["log2_ChipDivInput"].values)
-		MetaDF.drop(columns=["log2_ChipDivInput"],inplace=True)
-	# load in meta data	
-	for Meta in list(MetaDF):
-		HDF5_File.create_dataset(Meta,data=MetaDF[Meta].values.astype(bytes))
+def getCompression(Compression):
+	# h5py create_dataset arguments of each --compression choice
+	if Compression == "gzip":
+		return {"compression":"gzip", "compression_opts":4, "shuffle":True}
+	if Compression == "lzf":
+		return {"compression":"lzf", "shuffle":True}
+	if Compression == "blosc":
+		# optional, the filter plugin also has to be installed where it is read
+		try:
+			import hdf5plugin
+		except ImportError:
+			raise ImportError("--compression blosc requires hdf5plugin "+\
+								"(pip install hdf5plugin)")
+		return dict(hdf5plugin.Blosc(cname="lz4", clevel=5, 
+										shuffle=hdf5plugin.Blosc.SHUFFLE))
+	return {}
+
+#------------------------------------------------------------------------------
+# 5a)
+def initHDF5(HDF5_File, FeatureShape, MetaDF, FeatureDtype, FeatureAttrs,
+				ChunkSize, Compression):
+	# every dataset resizable along promoters, chunks of ChunkSize promoters
+	CompressionArgs = getCompression(Compression)
+	# create "image" feature dataset, (0,R,W,F)
+	HDF5_File.create_dataset("FeatureInput", shape=(0,)+FeatureShape,
+							maxshape=(None,)+FeatureShape, dtype=FeatureDtype, 
+							chunks=(ChunkSize,)+FeatureShape, **CompressionArgs)
+	# layout and scaler of the features
+	for Attr, Value in FeatureAttrs.items():
+		HDF5_File["FeatureInput"].attrs[Attr] = Value
+	# create response variable dataset(s), one per mark
+	for RespVar in [c for c in list(MetaDF) if c.startswith("log2_ChipDivInput")]:
+		HDF5_File.create_dataset(RespVar, shape=(0,), maxshape=(None,), 
+							dtype=np.float64, chunks=(ChunkSize,), **CompressionArgs)
+	# meta data, one table of variable length strings
+	MetaDtype = np.dtype([(Meta, h5py.special_dtype(vlen=str)) for Meta in list(MetaDF) \
+							if not Meta.startswith("log2_ChipDivInput")])
+	HDF5_File.create_dataset("MetaData", shape=(0,), maxshape=(None,), 
+							dtype=MetaDtype, chunks=(ChunkSize,), **CompressionArgs)
+
+#------------------------------------------------------------------------------
+# 5b)
+def checkHDF5(HDF5_File, FeatureShape, MetaDF, FeatureAttrs):
+	# a shard is appended only to a file of the same layout, scaler and columns
+	Attrs = HDF5_File["FeatureInput"].attrs
+	Mismatch = []
+	if HDF5_File["FeatureInput"].shape[1:] != FeatureShape:
+		Mismatch.append("FeatureInput "+str(HDF5_File["FeatureInput"].shape[1:]))
+	for Attr, Value in FeatureAttrs.items():
+		if Attr not in Attrs:
+			Mismatch.append(Attr)
+			continue
+		FileValue, Value = np.asarray(Attrs[Attr]), np.asarray(Value)
+		# scaler min/max is np.nan where no promoter has a value
+		if FileValue.dtype.kind == "f":
+			FileValue, Value = np.nan_to_num(FileValue, nan=np.inf), \
+								np.nan_to_num(Value, nan=np.inf)
+		if not np.array_equal(FileValue, Value):
+			Mismatch.append(Attr)
+	FileCols = sorted([Dataset for Dataset in HDF5_File \
+						if Dataset.startswith("log2_ChipDivInput")] + \
+						list(HDF5_File["MetaData"].dtype.names))
+	if FileCols != sorted(MetaDF):
+		Mismatch.append("columns "+str(FileCols))
+	if Mismatch:
+		raise ValueError("Cannot append, "+HDF5_File.filename+" differs in: "+\
+							", ".join(Mismatch))
+
+#------------------------------------------------------------------------------
+# 5c)
+def appendHDF5(HDF5_File, ReshapedImageArray, MetaDF):
+	Start = HDF5_File["FeatureInput"].shape[0]
+	Stop = Start + ReshapedImageArray.shape[0]
+	HDF5_File["FeatureInput"].resize(Stop, axis=0)
+	HDF5_File["FeatureInput"][Start:Stop] = ReshapedImageArray
+	for RespVar in [c for c in list(MetaDF) if c.startswith("log2_ChipDivInput")]:
+		HDF5_File[RespVar].resize((Stop,))
+		HDF5_File[RespVar][Start:Stop] = MetaDF[RespVar].values
+	MetaArray = np.empty(MetaDF.shape[0], dtype=HDF5_File["MetaData"].dtype)
+	for Meta in MetaArray.dtype.names:
+		MetaArray[Meta] = MetaDF[Meta].astype(str).values
+	HDF5_File["MetaData"].resize((Stop,))
+	HDF5_File["MetaData"][Start:Stop] = MetaArray
+
+#------------------------------------------------------------------------------
+# 5d)
+def createHDF5(ReshapedImageArray, MetaDF, OutputFilePath, FeatureDtype="float64",
+				FeatureAttrs=None, ChunkSize=512, Compression=None, Append=False):
+	FeatureAttrs = FeatureAttrs or {}
+	FeatureShape = ReshapedImageArray.shape[1:]
+	if Append and os.path.exists(OutputFilePath):
+		HDF5_File = h5py.File(OutputFilePath, mode="a")
+		checkHDF5(HDF5_File, FeatureShape, MetaDF, FeatureAttrs)
+	else:
+		# initial hdf5 file 
+		HDF5_File = h5py.File(OutputFilePath, mode="w")
+		initHDF5(HDF5_File, FeatureShape, MetaDF, FeatureDtype, FeatureAttrs,
+					ChunkSize, Compression)
+	appendHDF5(HDF5_File, ReshapedImageArray.astype(HDF5_File["FeatureInput"].dtype), 
+				MetaDF)
+	print("FeatureInput", HDF5_File["FeatureInput"].shape)
 	HDF5_File.close()
 	print("Created HDF5 Dataset:", OutputFilePath)
 
 #------------------------------------------------------------------------------
 def main(LineArgs):
 	T0 = time.time()
+	if LineArgs.scalerOnly and not LineArgs.saveScaler:
+		raise ValueError("--scalerOnly needs --saveScaler")
 	# Variable input
-	MethylationFilePath = LineArgs.MethylationFilePath
-	Sample = ".".join(MethylationFilePath.split("/")[-1].split(".")[:-1])
+	MethylationFilePathList = LineArgs.MethylationFilePath
+	Sample = ".".join(MethylationFilePathList[0].split("/")[-1].split(".")[:-1])
 	OutputFilePath = LineArgs.outDirectory
 	if not os.path.exists(LineArgs.outDirectory):
 		os.mkdir(LineArgs.outDirectory)
@@ -280,35 +504,64 @@ def main(LineArgs):
 		OutputFilePath += "/" + Sample+".h5"
 	else:
 		OutputFilePath += "/" + LineArgs.outFileName
-	# hard coded parameters
-	NumOfWin = 20
-	WindowSizeList = [250, 2500]
-	# 1) prep methylation for interleaving feature arrays:
-	# 1.1) load data, remove extraneous columns
-	# 1.1) slice extraneous columns into MetaData DF:
-	#		positional, gene/transcript IDs, etc.
-	# 1.2) Scale Features, minmax .1-1, replace np.nan with 0 after scaling
-	ScaledMethylDF, MetaDF = prepMethylationData(MethylationFilePath, 
-																WindowSizeList)
-	# 2) Combines data into reshaped arrays for CNN model input
-	# 2.1) Split features by corresponding window size
-	# 2.2) Interleave columns, 2.2.1) Get column order by sorting
-	# 2.3) Interleave rows (promoters/transcripts) on index (resolutions)
-	# 2.4) reshape DF to arrray
-	ReshapedImageArray, SortedIndex = runCombineDataPipeline(ScaledMethylDF, 
-														NumOfWin, WindowSizeList)
+	# 0) window configuration used by the feature stage (default 20 windows of
+	# 250bp and 2500bp)
+	NumOfWin, WindowSizeList, FeatureList = getWindowConfig(MethylationFilePathList[0])
+	print("Using windows:", NumOfWin, "x", WindowSizeList)
+	# 0b) every shard (e.g. chromosome) with the same header, before any is read
+	checkShardHeaders(MethylationFilePathList)
 	# 3) load Response variable data if available
+	ResponseVarDF = None
 	if LineArgs.ResponseVariablePath:
-		ResponseVarDF = pd.read_csv(LineArgs.ResponseVariablePath, header="infer",sep="\t")
-		ResponseVarDF.set_index("EnsmblID_T",inplace=True,drop=True)
-		# keeping only the relevant column (response variable)
-		ResponseVarDF = ResponseVarDF[["log2_ChipDivInput"]]
-		# concat with MetaDF for easy sorting and addition to H5 file
-		MetaDF = pd.concat([MetaDF,ResponseVarDF],axis=1)
-	# 4) sort meta df on index to match corresponding promoter data
-	SortedMetaDF = sortMetaDF(SortedIndex, MetaDF)
-	# 5) convert arrays  and metaDF to hdf5 datasets:
-	createHDF5(ReshapedImageArray, SortedMetaDF, OutputFilePath)
+		ResponseVarDF = loadResponseVariable(LineArgs.ResponseVariablePath)
+	#--------------------------------------------------------------------------
+	def writeShard(ReshapedImageArray, MetaDF, Append):
+		# 2f) Scale Features, minmax .1-1, replace np.nan with 0 after scaling
+		ReshapedImageArray = scaleFeatureArray(ReshapedImageArray, DataMin, DataMax)
+		if ResponseVarDF is not None:
+			# joined on MetaDF, keeps the promoter order of the feature array
+			MetaDF = MetaDF.join(ResponseVarDF, how="left")
+		# 5) convert arrays  and metaDF to hdf5 datasets:
+		FeatureAttrs = {"WindowSizes":WindowSizeList, "NumWindows":NumOfWin,
+						"Features":np.array(FeatureList, dtype=bytes),
+						"ScalerMin":DataMin, "ScalerMax":DataMax}
+		createHDF5(ReshapedImageArray, MetaDF, OutputFilePath, 
+					LineArgs.featureDtype, FeatureAttrs, LineArgs.chunkSize,
+					LineArgs.compression, Append)
+
+	#--------------------------------------------------------------------------
+	# 2b) Scaler per resolution/ feature: saved min/max (2e, several shard 
+	# scalers are merged, 2c), or the min/max of all shards given
+	if LineArgs.scaler:
+		DataMin, DataMax = mergeScalerParams([loadScaler(ScalerFilePath, 
+									WindowSizeList, FeatureList) \
+								for ScalerFilePath in LineArgs.scaler])
+	# with a saved scaler each shard is written as soon as it is built, 
+	# otherwise shards are kept until the min/max of all of them is known
+	Stream = LineArgs.scaler and not LineArgs.scalerOnly
+	Append = LineArgs.append
+	ShardList = []
+	ScalerList = []
+	# 1/ 1b/ 2) one pass over the shards, building each (N,R,W,F) array
+	for ReshapedImageArray, MetaDF in iterFeatureShards(MethylationFilePathList,
+														NumOfWin, WindowSizeList):
+		if Stream:
+			writeShard(ReshapedImageArray, MetaDF, Append)
+			Append = True
+			continue
+		ScalerList.append(getScalerParams(ReshapedImageArray))
+		if not LineArgs.scalerOnly:
+			ShardList.append((ReshapedImageArray, MetaDF))
+	if not LineArgs.scaler:
+		DataMin, DataMax = mergeScalerParams(ScalerList)
+	# 2d) reduce pass: the scaler is all that is needed from this input
+	if LineArgs.saveScaler:
+		saveScaler(LineArgs.saveScaler, DataMin, DataMax, WindowSizeList, 
+					FeatureList)
+	while ShardList:
+		ReshapedImageArray, MetaDF = ShardList.pop(0)
+		writeShard(ReshapedImageArray, MetaDF, Append)
+		Append = True
 	print("Total time for Image Feature Processing,", str(time.time()-T0)+"s")
 
 # Capture command line args, with or without defaults
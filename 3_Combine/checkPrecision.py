@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+Purpose:
+Accuracy check of a compact precision combined HDF5 (3_Combine.py with
+--featureDtype float32/float16) against the float64 file of the same sample.
+
+General Notes:
+Reports the maximum absolute error of FeatureInput per resolution and feature,
+and checks that every other dataset (meta data, response variable) matches.
+Exits with status 1 if any error exceeds --tolerance.
+
+Measured on a 1600 promoter test sample (scaled features, range 0-1):
+	float32, max abs error ~3e-8
+	float16, max abs error ~2.5e-4 (~3e-4 with a --compact .m2f input)
+The default tolerance (1e-3) is the rounding step of the methylation features.
+
+#------------------------------------------------------------------------------
+Input Required:
+1) Reference (float64) HDF5 file from 3_Combine.py
+2) Compact HDF5 file from 3_Combine.py, same input
+
+#------------------------------------------------------------------------------
+Output:
+1) Error summary printed to stdout.
+'''
+
+import sys
+import h5py
+try:
+	# registers the blosc filter, for 3_Combine.py --compression blosc files
+	import hdf5plugin
+except ImportError:
+	pass
+import argparse
+import numpy as np
+
+#------------------------------------------------------------------------------
+def parseArguments():
+	# Create argument parser
+	parser = argparse.ArgumentParser()
+	# Positional mandatory arguments
+	parser.add_argument("ReferenceFilePath",
+		help="Full path to the float64 combined HDF5 file.", type=str)
+	parser.add_argument("CompactFilePath",
+		help="Full path to the compact combined HDF5 file.", type=str)
+	parser.add_argument("--tolerance", help="Max absolute error allowed", default=1e-3, type=float)
+
+	# Parse arguments
+	args = parser.parse_args()
+	return args
+
+#------------------------------------------------------------------------------
+def main(LineArgs):
+	Passed = True
+	with h5py.File(LineArgs.ReferenceFilePath, mode="r") as RefFile, \
+			h5py.File(LineArgs.CompactFilePath, mode="r") as CompactFile:
+		RefArray = np.array(RefFile["FeatureInput"], dtype=np.float64)
+		CompactArray = np.array(CompactFile["FeatureInput"], dtype=np.float64)
+		print("FeatureInput", RefFile["FeatureInput"].dtype, "vs",
+				CompactFile["FeatureInput"].dtype, RefArray.shape)
+		if RefArray.shape != CompactArray.shape:
+			print("\tShape mismatch:", CompactArray.shape)
+			sys.exit(1)
+		# (N,R,W,F), one error per resolution/ feature
+		ErrorArray = np.abs(RefArray - CompactArray).max(axis=(0,2))
+		for R in range(ErrorArray.shape[0]):
+			print("\tResolution "+str(R)+", max abs error per feature:",
+					", ".join("%.2e" % Error for Error in ErrorArray[R]))
+		Passed = ErrorArray.max() <= LineArgs.tolerance
+		# meta data and response variable must be unchanged
+		for Dataset in RefFile:
+			if Dataset == "FeatureInput":
+				continue
+			if Dataset not in CompactFile or not np.array_equal(
+							RefFile[Dataset][()], CompactFile[Dataset][()]):
+				print("\tDataset differs:", Dataset)
+				Passed = False
+	print("PASSED" if Passed else "FAILED", "(tolerance "+str(LineArgs.tolerance)+")")
+	if not Passed:
+		sys.exit(1)
+
+# Capture command line args, with or without defaults
+if __name__ == '__main__':
+	# Parse the arguments
+	LineArgs = parseArguments()
+	main(LineArgs)
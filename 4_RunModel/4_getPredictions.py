@@ -13,60 +13,172 @@ Output:
 1) tab delimited file of predictions and corresponding 
 	promoter regions/transcripts/genes
 
+Features are read from the H5 file --batchSize promoters at a time (the
+channels the model uses only), predicted, and appended to the output, so
+memory use does not grow with the number of promoters.
+
+Many samples (e.g. archived methylomes) are scored with one model load, and one
+TensorFlow start, with --manifest: a file of FeatureFilePath[<tab>OutFileName]
+lines, or - to read them from stdin as they come, e.g. from a long running
+process feeding samples as they are combined:
+	4_getPredictions.py M2A_H3K27ac_Model_V2.h5 --manifest samples.txt
+
+Several models (e.g. H3K27ac, H3K4me3 and transfer learned variants) are run on
+each batch as it is read, one pass over the features for all of them, giving
+one Predicted_* column per model (the model file name when two models would
+share a mark's column). --ensemble adds their mean and (population) variance,
+Predicted_EnsembleMean and Predicted_EnsembleVar, for models of one mark.
+	4_getPredictions.py Features.h5 M2A_H3K27ac_Model_V2.h5 M2A_H3K4me3_Model_V2.h5
+
+--backend numpy predicts without Keras/TensorFlow (numpyModel.py), from the
+Keras .h5 or a numpyModel.py export (.npz); it matches Keras to ~2e-6.
+
+CPU use: --batchSize sets the promoters read and predicted at a time, and
+--intraOpThreads/ --interOpThreads bound TensorFlow's thread pools (keras
+backend; the numpy backend follows OMP_NUM_THREADS) when several jobs share a
+node. --config reads these options from a JSON file, command line options take
+precedence. --autoTune times a few batch sizes on the (first) sample, uses the
+fastest and records it as batchSize in --config (or predictionConfig.json in the
+output directory), so later runs with that --config start from it:
+	4_getPredictions.py Features.h5 Model.h5 --autoTune --config node.json
+	4_getPredictions.py --manifest samples.txt Model.h5 --config node.json
+
 
 '''
 import time
 import os
+import sys
+import json
 import argparse
 import numpy as np
 import pandas as pd
 import h5py
-# model modules
-from keras.models import load_model
+try:
+	# registers the blosc filter, for 3_Combine.py --compression blosc files
+	import hdf5plugin
+except ImportError:
+	pass
+import numpyModel
+
+# batch sizes timed by --autoTune, on at most TuneNumPromoters promoters
+TuneBatchSizeList = [128, 256, 512, 1024, 2048, 4096]
+TuneNumPromoters = 8192
+TuneConfigFile = "predictionConfig.json"
 
 #------------------------------------------------------------------------------
 def parseArguments(): 
 	# Create argument parser
 	parser = argparse.ArgumentParser()   
 	# Positional mandatory arguments
-	parser.add_argument("FeatureFilePath", 
-		help="Full path to feature .h5 file.", type=str)
-	parser.add_argument("ModelFilePath", 
-		help="Full path to model .h5 file.", type=str)
+	parser.add_argument("FeatureFilePath", nargs="?",
+		help="Full path to feature .h5 file (omit with --manifest).", type=str)
+	parser.add_argument("ModelFilePath", nargs="+",
+		help="Full path to model .h5 file(s), one Predicted_* column each.", type=str)
 	parser.add_argument("--outFileName", help="File name to use for output", type=str)
 	parser.add_argument("--outDirectory", help="Directory to write output to", default="output", type=str)
+	parser.add_argument("--manifest", help="Score many feature files with one "+\
+		"model load: file of FeatureFilePath[<tab>OutFileName] lines, or - for stdin", 
+		type=str)
+	parser.add_argument("--ensemble", help="Add the mean and variance over "+\
+		"all models (Predicted_EnsembleMean, Predicted_EnsembleVar)", action="store_true")
+	parser.add_argument("--backend", help="keras, or numpy: no Keras/TensorFlow "+\
+		"import, Keras .h5 or numpyModel.py export", choices=["keras","numpy"], 
+		default="keras", type=str)
+	parser.add_argument("--batchSize", help="Promoters read and predicted at a time", 
+		default=512, type=int)
+	parser.add_argument("--intraOpThreads", help="TensorFlow threads per "+\
+		"operation (keras backend), 0 for TensorFlow's default", default=0, type=int)
+	parser.add_argument("--interOpThreads", help="TensorFlow operations run "+\
+		"at once (keras backend), 0 for TensorFlow's default", default=0, type=int)
+	parser.add_argument("--autoTune", help="Time batch sizes on the first "+\
+		"sample, use the fastest and record it in --config (or "+\
+		"<outDirectory>/"+TuneConfigFile+")", action="store_true")
+	parser.add_argument("--config", help="JSON file of option defaults, e.g. "+\
+		"{\"batchSize\": 1024, \"intraOpThreads\": 2}; command line options "+\
+		"take precedence", type=str)
 
+	# option defaults from --config
+	ConfigArgs, _ = parser.parse_known_args()
+	if ConfigArgs.config and os.path.exists(ConfigArgs.config):
+		with open(ConfigArgs.config) as ConfigFile:
+			ConfigDict = json.load(ConfigFile)
+		Unknown = [Key for Key in ConfigDict if Key not in vars(ConfigArgs)]
+		if Unknown:
+			parser.error("unknown option(s) in "+ConfigArgs.config+": "+str(Unknown))
+		parser.set_defaults(**ConfigDict)
+	elif ConfigArgs.config and not ConfigArgs.autoTune:
+		parser.error("config file not found: "+ConfigArgs.config)
 	# Parse arguments
 	args = parser.parse_args()
 	return args
 
 #------------------------------------------------------------------------------
-def parseInput(InFile):
-	# Read h5 feature input and meta data
-	SampleDataHDF = h5py.File(InFile, mode="r")
-	#----------------------------------------------------------------------
+def getFeatureIdx(FeatureDataset):
+	# channels used by the models: Ave, FracSSD, Var (the SSD channel is not)
+	if "Features" in FeatureDataset.attrs:
+		FeatureList = [f.decode() for f in FeatureDataset.attrs["Features"]]
+		return [FeatureList.index(Feat) for Feat in ["M_Ave","M_FracSSD","M_Var"]]
+	return [0,1,3]
+
+#------------------------------------------------------------------------------
+def readMetaData(SampleDataHDF, Start, Stop):
 	# build DF
 	Cols = ["Transcript", "Gene",  "GeneName", 
 				"Chr", "Start", "End", "Strand"]
 	IdxList = ["EnsmblID_T", "EnsmblID_G",  "Gene", 
 				"Chr", "Start", "End", "Strand"]
+	# one "MetaData" table, or one bytes dataset per column (older files)
+	if "MetaData" in SampleDataHDF:
+		MetaArray = SampleDataHDF["MetaData"][Start:Stop]
+		# variable length strings read as str (h5py 2) or bytes (h5py 3)
+		MetaDict = {Idx:np.array([v.decode() if isinstance(v, bytes) else v \
+							for v in MetaArray[Idx]]) for Idx in IdxList}
+	else:
+		MetaDict = {Idx:SampleDataHDF[Idx][Start:Stop] for Idx in IdxList}
 	MetaDF = pd.DataFrame(columns=Cols)
 	for Col, Idx in zip(Cols, IdxList):
-		MetaDF[Col] = np.array(SampleDataHDF[Idx])
+		MetaDF[Col] = MetaDict[Idx]
 		MetaDF[Col] = MetaDF[Col].astype(str).str.replace("b'","",regex=True)
 		MetaDF[Col] = MetaDF[Col].astype(str).str.replace("'","",regex=True)
-	# Test data
-	TestData = np.array(SampleDataHDF["FeatureInput"])[:,:,:,[0,1,3]] # slice features
-	return MetaDF, TestData
+	return MetaDF
+
+#------------------------------------------------------------------------------
+def iterInputBatches(InFile, BatchSize):
+	# Read h5 feature input and meta data, BatchSize promoters at a time
+	# (3_Combine.py chunks hold 512 promoters by default)
+	with h5py.File(InFile, mode="r") as SampleDataHDF:
+		FeatureDataset = SampleDataHDF["FeatureInput"]
+		FeatureIdx = getFeatureIdx(FeatureDataset)
+		for Start in range(0, FeatureDataset.shape[0], BatchSize):
+			Stop = min(Start+BatchSize, FeatureDataset.shape[0])
+			# Test data, unused features are not read
+			TestData = FeatureDataset[Start:Stop,:,:,FeatureIdx].astype(np.float32)
+			yield readMetaData(SampleDataHDF, Start, Stop), TestData
+
+#-------------------------------------------------------------------------#
+def configureThreads(IntraOpThreads, InterOpThreads):
+	# TensorFlow thread pools, set before any model is loaded
+	import tensorflow as tf
+	if hasattr(tf, "ConfigProto"):
+		# TensorFlow 1.x, the session Keras runs in
+		from keras import backend as K
+		K.set_session(tf.Session(config=tf.ConfigProto(
+							intra_op_parallelism_threads=IntraOpThreads,
+							inter_op_parallelism_threads=InterOpThreads)))
+	else:
+		tf.config.threading.set_intra_op_parallelism_threads(IntraOpThreads)
+		tf.config.threading.set_inter_op_parallelism_threads(InterOpThreads)
 
 #-------------------------------------------------------------------------#
-def getPredictions(MetaDF, TestData, ModelFilePath):
-	# load model weights
-	FitModel = load_model(ModelFilePath)
-	# Return regression predictions
-	PredReg = FitModel.predict(TestData, 
-								batch_size=512, 
-								verbose=1)
+def loadModel(ModelFilePath, Backend):
+	if Backend == "numpy":
+		return numpyModel.loadModel(ModelFilePath)
+	# model modules, imported only for this backend
+	from keras.models import load_model
+	return load_model(ModelFilePath)
+
+#-------------------------------------------------------------------------#
+def getPredColName(ModelFilePath):
 	if "H3K27ac" in ModelFilePath:
 		PredColName = "Predicted_H3K27ac"
 	elif "H3K4me3" in ModelFilePath:
@@ -74,30 +186,193 @@ def getPredictions(MetaDF, TestData, ModelFilePath):
 	else:
 		ModelName = ModelFilePath.split("/")[-1]
 		PredColName = "Predicted_"+ModelName
-	MetaDF[PredColName] = PredReg.flatten()
+	return PredColName
+
+#-------------------------------------------------------------------------#
+def getPredColNames(ModelFilePathList):
+	PredColNameList = [getPredColName(ModelFilePath) \
+						for ModelFilePath in ModelFilePathList]
+	# models of the same mark (e.g. transfer learned variants) by file name
+	PredColNameList = [PredColName if PredColNameList.count(PredColName) == 1 \
+						else "Predicted_"+ModelFilePath.split("/")[-1] \
+						for PredColName, ModelFilePath in \
+							zip(PredColNameList, ModelFilePathList)]
+	if len(set(PredColNameList)) != len(PredColNameList):
+		raise ValueError("Models need distinct file names: "+\
+							str(ModelFilePathList))
+	return PredColNameList
+
+#-------------------------------------------------------------------------#
+def getPredictions(FitModelList, MetaDF, TestData, PredColNameList, BatchSize,
+					Ensemble=False):
+	# Return regression predictions, every model on the same batch
+	for FitModel, PredColName in zip(FitModelList, PredColNameList):
+		PredReg = FitModel.predict(TestData, 
+									batch_size=BatchSize, 
+									verbose=0)
+		MetaDF[PredColName] = PredReg.flatten()
+	if Ensemble:
+		MetaDF["Predicted_EnsembleMean"] = MetaDF[PredColNameList].mean(axis=1)
+		MetaDF["Predicted_EnsembleVar"] = MetaDF[PredColNameList].var(axis=1, ddof=0)
 	return MetaDF
 
+#------------------------------------------------------------------------------
+def tuneBatchSize(FitModelList, FeatureFilePath):
+	# read and predict time of each batch size on the sample's first promoters
+	with h5py.File(FeatureFilePath, mode="r") as SampleDataHDF:
+		FeatureDataset = SampleDataHDF["FeatureInput"]
+		FeatureIdx = getFeatureIdx(FeatureDataset)
+		NumPromoters = min(TuneNumPromoters, FeatureDataset.shape[0])
+		#----------------------------------------------------------------------
+		def runBatches(BatchSize):
+			T0 = time.time()
+			for Start in range(0, NumPromoters, BatchSize):
+				Stop = min(Start+BatchSize, NumPromoters)
+				TestData = FeatureDataset[Start:Stop,:,:,FeatureIdx].astype(np.float32)
+				for FitModel in FitModelList:
+					FitModel.predict(TestData, batch_size=BatchSize, verbose=0)
+			return time.time() - T0
+
+		#----------------------------------------------------------------------
+		# first calls (graph build, caches) are not timed
+		runBatches(TuneBatchSizeList[0])
+		TimeList = []
+		for BatchSize in TuneBatchSizeList:
+			# best of two, less noise from other jobs on the node
+			TimeList.append(min(runBatches(BatchSize), runBatches(BatchSize)))
+			print("Batch size", BatchSize, "%.0f promoters/s" % \
+					(NumPromoters/max(TimeList[-1], 1e-9)), flush=True)
+	return TuneBatchSizeList[int(np.argmin(TimeList))]
+
+#------------------------------------------------------------------------------
+def saveConfig(ConfigFilePath, **Options):
+	# options added to (or replaced in) the config file
+	ConfigDict = {}
+	if os.path.exists(ConfigFilePath):
+		with open(ConfigFilePath) as ConfigFile:
+			ConfigDict = json.load(ConfigFile)
+	ConfigDict.update(Options)
+	with open(ConfigFilePath, "w") as ConfigFile:
+		json.dump(ConfigDict, ConfigFile, indent=1)
+	print("Saved config:", ConfigFilePath, ConfigDict)
+
+#------------------------------------------------------------------------------
+def iterManifest(ManifestPath):
+	# FeatureFilePath[\tOutFileName] per line, blank and "#" lines skipped;
+	# "-" reads stdin, each sample is scored as soon as its line arrives
+	ManifestFile = sys.stdin if ManifestPath == "-" else open(ManifestPath)
+	try:
+		for Line in ManifestFile:
+			Fields = Line.rstrip("\n").split("\t")
+			if not Fields[0].strip() or Fields[0].startswith("#"):
+				continue
+			yield Fields[0].strip(), \
+					Fields[1].strip() if len(Fields) > 1 and Fields[1].strip() else None
+	finally:
+		if ManifestFile is not sys.stdin:
+			ManifestFile.close()
+
+#------------------------------------------------------------------------------
+def getOutputFilePath(FeatureFilePath, OutFileName, OutDirectory):
+	Sample = ".".join(FeatureFilePath.split("/")[-1].split(".")[:-1])
+	OutputFilePath = OutDirectory
+	if not OutFileName:
+		OutputFilePath += "/" + "Predictions_"+Sample+".txt"
+	else:
+		OutputFilePath += "/" + OutFileName
+	return OutputFilePath
+
+#------------------------------------------------------------------------------
+def scoreSample(FitModelList, PredColNameList, FeatureFilePath, OutputFilePath, 
+				BatchSize, Ensemble=False):
+	# parse test data, meta data and predict one batch at a time, appending
+	# each batch to the output: memory is bound by the batch size
+	T0 = time.time()
+	NumPredicted = 0
+	# written aside then renamed, a failed sample leaves no partial table
+	TempPath = OutputFilePath+".tmp"
+	try:
+		with open(TempPath, "w") as OutputFile:
+			for MetaDF, TestData in iterInputBatches(FeatureFilePath, BatchSize):
+				PredictionsDF = getPredictions(FitModelList, MetaDF, TestData, 
+												PredColNameList, BatchSize, Ensemble)
+				PredictionsDF.to_csv(OutputFile, sep="\t", header=NumPredicted==0, 
+										index=False)
+				NumPredicted += PredictionsDF.shape[0]
+	except BaseException:
+		# absent if the open itself failed, keep that error
+		if os.path.exists(TempPath):
+			os.remove(TempPath)
+		raise
+	os.replace(TempPath, OutputFilePath)
+	print("Predicted promoters:", NumPredicted, FeatureFilePath, "->", 
+			OutputFilePath, str(time.time()-T0)+"s", flush=True)
+
 #------------------------------------------------------------------------------
 def main(LineArgs):
 	T0 = time.time()
 	# Commandline args and model params
-	FeatureFilePath = LineArgs.FeatureFilePath
-	ModelFilePath = LineArgs.ModelFilePath
-	# parse test data, meta data
-	MetaDF, TestData = parseInput(FeatureFilePath)
-	PredictionsDF = getPredictions(MetaDF, TestData, ModelFilePath)
-	####
-	Sample = ".".join(FeatureFilePath.split("/")[-1].split(".")[:-1])
-	OutputFilePath = LineArgs.outDirectory
+	ModelFilePathList = LineArgs.ModelFilePath
+	if LineArgs.manifest:
+		if LineArgs.outFileName:
+			raise ValueError("--outFileName is per sample, give it in the manifest")
+		# with --manifest every positional argument is a model
+		if LineArgs.FeatureFilePath:
+			ModelFilePathList = [LineArgs.FeatureFilePath] + ModelFilePathList
+	elif not LineArgs.FeatureFilePath:
+		raise ValueError("Give either FeatureFilePath or --manifest")
+	if LineArgs.ensemble and len(ModelFilePathList) < 2:
+		raise ValueError("--ensemble needs two or more models")
+	PredColNameList = getPredColNames(ModelFilePathList)
 	if not os.path.exists(LineArgs.outDirectory):
 		os.mkdir(LineArgs.outDirectory)
+	# thread pools of the keras backend, predictable CPU use on shared nodes
+	if LineArgs.backend == "keras" and \
+			(LineArgs.intraOpThreads or LineArgs.interOpThreads):
+		configureThreads(LineArgs.intraOpThreads, LineArgs.interOpThreads)
+	# load model weights, once for every sample
+	FitModelList = [loadModel(ModelFilePath, LineArgs.backend) \
+						for ModelFilePath in ModelFilePathList]
+	print("Models loaded:", ", ".join(PredColNameList)+",", 
+			str(time.time()-T0)+"s", flush=True)
+	BatchSize = LineArgs.batchSize
+	#--------------------------------------------------------------------------
+	def tuneOnSample(FeatureFilePath):
+		# --autoTune: fastest batch size on this sample, recorded for later runs
+		BatchSize = tuneBatchSize(FitModelList, FeatureFilePath)
+		print("Best batch size:", BatchSize, flush=True)
+		saveConfig(LineArgs.config if LineArgs.config else \
+					os.path.join(LineArgs.outDirectory, TuneConfigFile), 
+					batchSize=BatchSize)
+		return BatchSize
 
-	if not LineArgs.outFileName:
-		OutputFilePath += "/" + "Predictions_"+Sample+".txt"
+	#--------------------------------------------------------------------------
+	if not LineArgs.manifest:
+		if LineArgs.autoTune:
+			BatchSize = tuneOnSample(LineArgs.FeatureFilePath)
+		OutputFilePath = getOutputFilePath(LineArgs.FeatureFilePath, 
+								LineArgs.outFileName, LineArgs.outDirectory)
+		scoreSample(FitModelList, PredColNameList, LineArgs.FeatureFilePath, 
+					OutputFilePath, BatchSize, LineArgs.ensemble)
 	else:
-		OutputFilePath += "/" + LineArgs.outFileName
-
-	PredictionsDF.to_csv(OutputFilePath, sep="\t", header=True, index=False)
+		# a sample that cannot be read is reported, the others are still scored
+		FailedList = []
+		Tuned = not LineArgs.autoTune
+		for FeatureFilePath, OutFileName in iterManifest(LineArgs.manifest):
+			OutputFilePath = getOutputFilePath(FeatureFilePath, OutFileName, 
+												LineArgs.outDirectory)
+			try:
+				if not Tuned:
+					BatchSize = tuneOnSample(FeatureFilePath)
+					Tuned = True
+				scoreSample(FitModelList, PredColNameList, FeatureFilePath, 
+							OutputFilePath, BatchSize, LineArgs.ensemble)
+			except (OSError, KeyError, ValueError) as Error:
+				print("Failed:", FeatureFilePath, repr(Error), flush=True)
+				FailedList.append(FeatureFilePath)
+		if FailedList:
+			print("Failed samples:", len(FailedList))
+			sys.exit(1)
 	T1 = time.time()
 	TotalTime = T1 - T0
 	print ("Total time to complete,",str(TotalTime)+"s")
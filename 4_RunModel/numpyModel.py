@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+'''
+Purpose:
+Run the M2A CNN without Keras/TensorFlow: export a Keras model (.h5) to a
+portable .npz file, and predict with a NumPy implementation of its layers
+(4_getPredictions.py --backend numpy).
+
+General Notes:
+The M2A models are small Sequential CNNs, input (2,20,3):
+	3x Conv2D (8 filters, kernel (1,3), padding same) + LeakyReLU(0.1),
+	Flatten, Dense(64) + LeakyReLU(0.1), Dense(1)
+Supported layers: Conv2D (channels_last, stride and dilation 1, padding same or
+valid), LeakyReLU, Flatten and Dense, with linear or relu activations. Any other
+layer is an error at load time rather than a silent mismatch.
+
+The export reads the Keras file with h5py only (model_config and
+model_weights/<layer>/<layer>/kernel:0, bias:0). The .npz holds:
+	Config, JSON list of layers (class_name and the config used here)
+	<i>_kernel, <i>_bias, float32 weights of layer i
+A Keras .h5 can also be loaded directly by loadModel, without the export.
+
+Computation is float32, as in TensorFlow; predictions agree with Keras to
+float32 rounding (--verify reports the max abs difference).
+
+#------------------------------------------------------------------------------
+Input Required:
+1) Keras model .h5 file (e.g. M2A_H3K27ac_Model_V2.h5)
+
+#------------------------------------------------------------------------------
+Output:
+1) <Model>.npz, the exported model (--outFileName to rename).
+2) With --verify FeatureFile.h5, the max abs difference of NumPy vs Keras
+	predictions printed to stdout (requires Keras), exit status 1 if above
+	--tolerance.
+'''
+
+import os
+import sys
+import json
+import h5py
+try:
+	# registers the blosc filter, for 3_Combine.py --compression blosc files
+	import hdf5plugin
+except ImportError:
+	pass
+import argparse
+import numpy as np
+
+SupportedLayers = ["Conv2D", "LeakyReLU", "Flatten", "Dense"]
+SupportedActivations = ["linear", "relu"]
+
+#------------------------------------------------------------------------------
+def parseArguments():
+	# Create argument parser
+	parser = argparse.ArgumentParser()
+	# Positional mandatory arguments
+	parser.add_argument("ModelFilePath",
+		help="Full path to Keras model .h5 file.", type=str)
+	parser.add_argument("--outFileName", help="File name to use for output", type=str)
+	parser.add_argument("--outDirectory", help="Directory to write output to", default="output", type=str)
+	parser.add_argument("--verify", help="Feature .h5 file (3_Combine.py) to "+\
+		"compare NumPy and Keras predictions on", type=str)
+	parser.add_argument("--tolerance", help="Max absolute difference allowed", default=1e-4, type=float)
+
+	# Parse arguments
+	args = parser.parse_args()
+	return args
+
+#------------------------------------------------------------------------------
+def readKerasModel(ModelFilePath):
+	# layer list and weights of a Keras Sequential .h5, without Keras
+	with h5py.File(ModelFilePath, mode="r") as ModelFile:
+		ModelConfig = ModelFile.attrs["model_config"]
+		if isinstance(ModelConfig, bytes):
+			ModelConfig = ModelConfig.decode()
+		ModelConfig = json.loads(ModelConfig)
+		if ModelConfig["class_name"] != "Sequential":
+			raise ValueError("Only Sequential models are supported: "+ModelFilePath)
+		LayerConfigList = ModelConfig["config"]
+		if isinstance(LayerConfigList, dict):
+			# Keras >= 2.2.5 nests the layers
+			LayerConfigList = LayerConfigList["layers"]
+		LayerList = []
+		WeightDict = {}
+		for LayerIdx, LayerConfig in enumerate(LayerConfigList):
+			Config = LayerConfig["config"]
+			LayerList.append({"class_name":LayerConfig["class_name"],
+								"config":{Key:Config[Key] for Key in Config \
+									if Key in ["name", "padding", "strides",
+												"dilation_rate", "data_format",
+												"activation", "alpha", "use_bias"]}})
+			WeightGroup = ModelFile["model_weights"][Config["name"]]
+			if Config["name"] in WeightGroup:
+				for Weight in ["kernel", "bias"]:
+					if Weight+":0" in WeightGroup[Config["name"]]:
+						WeightDict[str(LayerIdx)+"_"+Weight] = np.array(
+							WeightGroup[Config["name"]][Weight+":0"], dtype=np.float32)
+	return LayerList, WeightDict
+
+#------------------------------------------------------------------------------
+def exportModel(ModelFilePath, OutputFilePath):
+	LayerList, WeightDict = readKerasModel(ModelFilePath)
+	# checked before anything is written
+	NumpyModel(LayerList, WeightDict)
+	with open(OutputFilePath, "wb") as OutputFile:
+		np.savez(OutputFile, Config=np.array(json.dumps(LayerList)), **WeightDict)
+	print("Exported model:", OutputFilePath)
+
+#------------------------------------------------------------------------------
+def loadModel(ModelFilePath):
+	# exported .npz, or the Keras .h5 itself
+	if h5py.is_hdf5(ModelFilePath):
+		return NumpyModel(*readKerasModel(ModelFilePath))
+	with np.load(ModelFilePath) as ModelFile:
+		LayerList = json.loads(str(ModelFile["Config"]))
+		WeightDict = {Weight:ModelFile[Weight] for Weight in ModelFile.files \
+						if Weight != "Config"}
+	return NumpyModel(LayerList, WeightDict)
+
+#------------------------------------------------------------------------------
+class NumpyModel(object):
+	def __init__(self, LayerList, WeightDict):
+		for LayerIdx, Layer in enumerate(LayerList):
+			Config = Layer["config"]
+			if Layer["class_name"] not in SupportedLayers:
+				raise ValueError("Layer not supported: "+Layer["class_name"])
+			if Config.get("activation", "linear") not in SupportedActivations:
+				raise ValueError("Activation not supported: "+Config["activation"])
+			if Layer["class_name"] == "Conv2D" and (
+					Config.get("data_format", "channels_last") != "channels_last" or \
+					list(Config.get("strides", [1,1])) != [1,1] or \
+					list(Config.get("dilation_rate", [1,1])) != [1,1] or \
+					Config.get("padding", "valid") not in ["same", "valid"]):
+				raise ValueError("Conv2D config not supported: "+str(Config))
+			if Layer["class_name"] in ["Conv2D", "Dense"] and \
+					str(LayerIdx)+"_kernel" not in WeightDict:
+				raise ValueError("Missing weights of layer "+str(LayerIdx))
+		self.LayerList = LayerList
+		self.WeightDict = WeightDict
+
+	#--------------------------------------------------------------------------
+	def conv2D(self, X, Kernel, Padding):
+		# X (N,H,W,C), Kernel (KH,KW,C,F): one matrix product per kernel offset
+		KH, KW = Kernel.shape[:2]
+		if Padding == "same":
+			# as TensorFlow, the extra pad of an even kernel goes after
+			X = np.pad(X, ((0,0), ((KH-1)//2, KH//2), ((KW-1)//2, KW//2), (0,0)),
+						mode="constant")
+		H, W = X.shape[1]-KH+1, X.shape[2]-KW+1
+		Out = np.zeros((X.shape[0], H, W, Kernel.shape[3]), dtype=np.float32)
+		for i in range(KH):
+			for j in range(KW):
+				Out += X[:,i:i+H,j:j+W,:] @ Kernel[i,j]
+		return Out
+
+	#--------------------------------------------------------------------------
+	def predictBatch(self, X):
+		for LayerIdx, Layer in enumerate(self.LayerList):
+			Config = Layer["config"]
+			Kernel = self.WeightDict.get(str(LayerIdx)+"_kernel")
+			Bias = self.WeightDict.get(str(LayerIdx)+"_bias")
+			if Layer["class_name"] == "Conv2D":
+				X = self.conv2D(X, Kernel, Config.get("padding", "valid"))
+			elif Layer["class_name"] == "Dense":
+				X = X @ Kernel
+			elif Layer["class_name"] == "Flatten":
+				# channels_last, the (H,W,C) order Keras flattens in
+				X = X.reshape(X.shape[0], -1)
+			elif Layer["class_name"] == "LeakyReLU":
+				X = np.where(X > 0, X, X * np.float32(Config.get("alpha", 0.3)))
+			if Bias is not None and Config.get("use_bias", True):
+				X += Bias
+			if Config.get("activation") == "relu":
+				X = np.maximum(X, 0)
+		return X
+
+	#--------------------------------------------------------------------------
+	def predict(self, X, batch_size=512, verbose=0):
+		# same call as a Keras model's predict
+		X = np.asarray(X, dtype=np.float32)
+		return np.concatenate([self.predictBatch(X[Start:Start+batch_size]) \
+								for Start in range(0, X.shape[0], batch_size)]) \
+				if X.shape[0] else np.zeros((0,1), dtype=np.float32)
+
+#------------------------------------------------------------------------------
+def verifyModel(ModelFilePath, ExportFilePath, FeatureFilePath, Tolerance):
+	# NumPy (exported model) vs Keras predictions on a combined feature file
+	from keras.models import load_model
+	with h5py.File(FeatureFilePath, mode="r") as SampleDataHDF:
+		FeatureDataset = SampleDataHDF["FeatureInput"]
+		FeatureIdx = [0,1,3]
+		if "Features" in FeatureDataset.attrs:
+			FeatureList = [f.decode() for f in FeatureDataset.attrs["Features"]]
+			FeatureIdx = [FeatureList.index(Feat) \
+							for Feat in ["M_Ave","M_FracSSD","M_Var"]]
+		TestData = FeatureDataset[:,:,:,FeatureIdx].astype(np.float32)
+	KerasPred = load_model(ModelFilePath).predict(TestData, batch_size=512,
+													verbose=0).flatten()
+	NumpyPred = loadModel(ExportFilePath).predict(TestData).flatten()
+	MaxDiff = np.abs(KerasPred - NumpyPred).max()
+	print("Promoters:", TestData.shape[0], "max abs difference NumPy vs Keras:",
+			"%.2e" % MaxDiff, "(predictions range %.2f to %.2f)" % \
+				(KerasPred.min(), KerasPred.max()))
+	return MaxDiff <= Tolerance
+
+#------------------------------------------------------------------------------
+def main(LineArgs):
+	OutputFilePath = LineArgs.outDirectory
+	if not os.path.exists(LineArgs.outDirectory):
+		os.mkdir(LineArgs.outDirectory)
+	if not LineArgs.outFileName:
+		Model = ".".join(LineArgs.ModelFilePath.split("/")[-1].split(".")[:-1])
+		OutputFilePath += "/" + Model+".npz"
+	else:
+		OutputFilePath += "/" + LineArgs.outFileName
+	exportModel(LineArgs.ModelFilePath, OutputFilePath)
+	if LineArgs.verify:
+		Passed = verifyModel(LineArgs.ModelFilePath, OutputFilePath, 
+								LineArgs.verify, LineArgs.tolerance)
+		print("PASSED" if Passed else "FAILED", "(tolerance "+str(LineArgs.tolerance)+")")
+		if not Passed:
+			sys.exit(1)
+
+# Capture command line args, with or without defaults
+if __name__ == '__main__':
+	# Parse the arguments
+	LineArgs = parseArguments()
+	main(LineArgs)
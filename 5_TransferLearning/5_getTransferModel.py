@@ -21,6 +21,11 @@ import numpy as np
 np.random.seed(9)
 import os
 import h5py
+try:
+	# registers the blosc filter, for 3_Combine.py --compression blosc files
+	import hdf5plugin
+except ImportError:
+	pass
 import pprint
 import argparse
 import pandas as pd
@@ -42,6 +47,8 @@ def parseArguments():
 		help="Full path to model .h5 file.", type=str)
 	parser.add_argument("--outFileName", help="File name prefix to use for output", type=str)
 	parser.add_argument("--outDirectory", help="Directory to write output to", default="output", type=str)
+	parser.add_argument("--responseVariable", help="Response variable dataset to train on, "+\
+		"e.g. log2_ChipDivInput_<Mark> for multi-mark inputs", default="log2_ChipDivInput", type=str)
 	# Parse arguments
 	args = parser.parse_args()
 	return args
@@ -76,12 +83,12 @@ def getCallBacks():
 	
 #------------------------------------------------------------------------------
 # 1.1) parse H5 file for input to model
-def parseInput(FeatureFilePath):
+def parseInput(FeatureFilePath, RespVar="log2_ChipDivInput"):
 	SampleDataHDF = h5py.File(FeatureFilePath, mode="r")
 	# train data
-	TrainData = np.array(SampleDataHDF["FeatureInput"])[:,:,:,[0,1,3]] # slice features
+	TrainData = np.array(SampleDataHDF["FeatureInput"], dtype=np.float32)[:,:,:,[0,1,3]] # slice features
 	# respvar
-	TrainRespVar = np.array(SampleDataHDF["log2_ChipDivInput"])
+	TrainRespVar = np.array(SampleDataHDF[RespVar])
 	# shuffle data
 	TrainData, TrainRespVar = shuffle(TrainData, 
 									TrainRespVar,
@@ -92,11 +99,12 @@ def parseInput(FeatureFilePath):
 # 1) Initalize transfer learning object
 class learning_pipeline(object):
 	#-------------------------------------------------------------------------#
-	def __init__(self, FeatureFilePath, ModelFilePath, OutputFilePath):
+	def __init__(self, FeatureFilePath, ModelFilePath, OutputFilePath, 
+					RespVar="log2_ChipDivInput"):
 		self.OutputFilePath = OutputFilePath
 		self.ModelFilePath = ModelFilePath
 		# 1.1) parse H5 file for input to model
-		self.TrainData, self.TrainRespVar = parseInput(FeatureFilePath)
+		self.TrainData, self.TrainRespVar = parseInput(FeatureFilePath, RespVar)
 		# Training parameters
 		self.Valid_Split = .2
 		self.Epochs = 80
@@ -202,7 +210,8 @@ def main(LineArgs):
 		OutputFilePath += "/" + LineArgs.outFileName
 	# 1) Initalize transfer learning object
 	# 	1.1) parse H5 file for input to model
-	TrainPipe = learning_pipeline(FeatureFilePath, ModelFilePath, OutputFilePath)
+	TrainPipe = learning_pipeline(FeatureFilePath, ModelFilePath, OutputFilePath,
+									LineArgs.responseVariable)
 	# 2) Training and return model instances
 	# 	2.1) build callback classes
 	FitModel, TransferModel, LossHistory = TrainPipe.trainCNN()